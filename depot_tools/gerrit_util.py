@@ -1094,6 +1094,13 @@ def ReadHttpResponse(conn: HttpConn,
     Returns:
         A string buffer containing the connection's reply.
     """
+    return _ReadHttpResponse(conn, accept_statuses, max_tries)[1]
+
+
+def _ReadHttpResponse(
+        conn: HttpConn, accept_statuses: Container[int],
+        max_tries: int) -> Tuple[httplib2.Response, StringIO]:
+    """Like ReadHttpResponse, but also returns the response itself."""
     response = contents = None
     sleep_time = SLEEP_TIME
     for idx in range(max_tries):
@@ -1150,7 +1157,7 @@ def ReadHttpResponse(conn: HttpConn,
         'Impossible: End of retry loop without response or exception.')
 
     if response.status in accept_statuses:
-        return StringIO(contents)
+        return response, StringIO(contents)
 
     if response.status in (302, 401, 403):
         www_authenticate = response.get('www-authenticate')
@@ -1173,7 +1180,11 @@ def ReadHttpJsonResponse(conn,
                          accept_statuses: Container[int] = frozenset([200]),
                          max_tries=TRY_LIMIT) -> dict:
     """Parses an https response as json."""
-    fh = ReadHttpResponse(conn, accept_statuses, max_tries)
+    return _ParseJsonResponse(ReadHttpResponse(conn, accept_statuses,
+                                               max_tries))
+
+
+def _ParseJsonResponse(fh: StringIO) -> dict:
     # The first line of the response should always be: )]}'
     s = fh.readline()
     if s and s.rstrip() != ")]}'":
@@ -1370,6 +1381,26 @@ def GetChangeDetail(host, change, o_params=None):
     return ReadHttpJsonResponse(CreateHttpConn(host, path))
 
 
+def GetChangeDetailIfModified(
+        host, change, o_params=None,
+        etag=None) -> Tuple[Optional[str], Optional[dict]]:
+    """Like GetChangeDetail, but revalidates a previously fetched copy.
+
+    Returns (etag, None) if |etag| still matches the change on the server, so
+    that the cached copy can be reused. Otherwise, returns the new ETag (None
+    if the server did not send one) and the change detail.
+    """
+    path = 'changes/%s/detail' % change
+    if o_params:
+        path += '?%s' % '&'.join(['o=%s' % p for p in o_params])
+    headers = {'If-None-Match': etag} if etag else None
+    conn = CreateHttpConn(host, path, headers=headers)
+    response, fh = _ReadHttpResponse(conn, frozenset([200, 304]), TRY_LIMIT)
+    if response.status == 304:
+        return etag, None
+    return response.get('etag'), _ParseJsonResponse(fh)
+
+
 def GetChangeCommit(host: str, change: str, revision: str = 'current') -> dict:
     """Query a Gerrit server for a revision associated with a change."""
     path = 'changes/%s/revisions/%s/commit?links' % (change, revision)
@@ -10,12 +10,14 @@ from __future__ import annotations
 
 import base64
 import collections
+import concurrent.futures
+import contextlib
 import datetime
 import enum
 import fnmatch
 import functools
 import httplib2
-import itertools
+import io
 import json
 import logging
 import multiprocessing
@@ -23,10 +25,12 @@ import optparse
 import os
 import re
 import shutil
+import sqlite3
 import stat
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 import typing
 import urllib.error
@@ -34,6 +38,7 @@ import urllib.parse
 import urllib.request
 import uuid
 import webbrowser
+import zipfile
 import zlib
 
 from typing import Any
@@ -63,12 +68,9 @@ import metrics_xml_format
 import newauth
 import owners_client
 import owners_finder
-import presubmit_canned_checks
-import presubmit_support
 import rustfmt
 import scm
 import setup_color
-import split_cl
 import subcommand
 import subprocess2
 import swift_format
@@ -93,12 +95,20 @@ PRESUBMIT_SUPPORT = os.path.join(DEPOT_TOOLS, 'presubmit_support.py')
 GIT_HASH_RE = re.compile(r'\b([a-f0-9]{6})[a-f0-9]{34}\b', flags=re.I)
 # Used to redact the cookies from the gitcookies file.
 GITCOOKIES_REDACT_RE = re.compile(r'1/.*')
+# Extracts the change numbers from the output of git push to Gerrit.
+_GERRIT_CHANGE_URL_RE = re.compile(
+    r'^remote:[^\S\n]+https?://[\w\-\.\+\/#]*/(\d+)[^\S\n]', re.MULTILINE)
 
 MAX_ATTEMPTS = 3
 
 # The maximum number of traces we will keep. Multiplied by 3 since we store
 # 3 files per trace.
 MAX_TRACES = 3 * 10
+# The files git push writes its traces to, inside a temporary directory.
+GIT_PUSH_TRACE_FILES = ('tr2-event', 'trace-curl', 'trace-packet')
+# Held while git push traces are stored and old ones pruned, so that two
+# uploads (e.g. a retry to the new default branch) don't race on TRACES_DIR.
+_GIT_PUSH_TRACES_LOCK = threading.Lock()
 # Message to be displayed to the user to inform where to find the traces for a
 # git-cl upload execution.
 TRACES_MESSAGE = (
@@ -169,10 +179,32 @@ _KNOWN_GERRIT_TO_SHORT_URLS = {
 assert len(_KNOWN_GERRIT_TO_SHORT_URLS) == len(
     set(_KNOWN_GERRIT_TO_SHORT_URLS.values())), 'must have unique values'
 
+# Gerrit message tags used by LUCI CQ/CV.
+_AUTOGEN_CQ_CV = ('autogenerated:cq', 'autogenerated:cv')
+
+# Frequently requested Changelist._GetChangeDetail options, built once.
+_CURRENT_REVISION_OPTS = frozenset({'CURRENT_REVISION', 'CURRENT_COMMIT'})
+_ALL_REVISIONS_OPTS = frozenset({'ALL_REVISIONS', 'CURRENT_COMMIT'})
+_DETAILED_ACCOUNTS_OPTS = frozenset({'DETAILED_ACCOUNTS'})
+_STATUS_OPTS = frozenset(
+    {'DETAILED_LABELS', 'CURRENT_REVISION', 'CURRENT_COMMIT', 'SUBMITTABLE'})
+
+# Cached Gerrit change details older than this are dropped instead of being
+# revalidated. See _ChangeDetailCache.
+_CHANGE_DETAIL_CACHE_TTL_SECONDS = 60 * 60
+
 # Maximum number of branches in a stack that can be traversed and uploaded
 # at once. Picked arbitrarily.
 _MAX_STACKED_BRANCHES_UPLOAD = 20
 
+# CMDlint only starts worker processes when linting at least this many files;
+# for fewer, the process start-up cost outweighs the parallelism.
+_LINT_PARALLEL_MIN_FILES = 8
+
+# Maximum number of commits OR'ed into a single Gerrit query by
+# CMDcherry_pick, to keep the request URL well under server limits.
+_MAX_CHERRY_PICK_QUERY_COMMITS = 20
+
 _NO_BRANCH_ERROR = (
     'Unable to determine base commit in detached HEAD state. '
     'Get on a branch or run `git cl upload --no-squash <base>` to '
@@ -227,7 +259,7 @@ def RunGit(args, **kwargs) -> str:
     return RunCommand(['git'] + args, **kwargs)
 
 
-def RunGitWithCode(args, suppress_stderr=False):
+def RunGitWithCode(args, suppress_stderr=False, stdin=None):
     """Returns return code and stdout."""
     if suppress_stderr:
         stderr = subprocess2.DEVNULL
@@ -236,6 +268,7 @@ def RunGitWithCode(args, suppress_stderr=False):
     try:
         (out, _), code = subprocess2.communicate(['git'] + args,
                                                  env=GetNoGitPagerEnv(),
+                                                 stdin=stdin,
                                                  stdout=subprocess2.PIPE,
                                                  stderr=stderr)
         return code, out.decode('utf-8', 'replace')
@@ -249,6 +282,19 @@ def RunGitSilent(args):
     return RunGitWithCode(args, suppress_stderr=True)[1]
 
 
+def ResolveGitObjects(revs):
+    """Resolves all revs (e.g. 'branch:' for a tree) with a single git process.
+
+    Returns a list with the object hash of each rev, or None where the rev
+    doesn't name an object.
+    """
+    out = RunGit(['cat-file', '--batch-check=%(objectname)'],
+                 stdin=''.join('%s\n' % rev for rev in revs).encode(),
+                 error_ok=True)
+    # Unresolvable revs are reported as "<rev> missing" or "<rev> ambiguous".
+    return [None if ' ' in line else line for line in out.splitlines()]
+
+
 def time_sleep(seconds):
     # Use this so that it can be mocked in tests without interfering with python
     # system machinery.
@@ -261,6 +307,12 @@ def time_time():
     return time.time()
 
 
+def run_in_background(fn, *args):
+    """Runs fn(*args) in a non-daemon thread, which Python waits for on exit."""
+    # Use this so that it can be mocked in tests to run synchronously.
+    threading.Thread(target=fn, args=args).start()
+
+
 def datetime_now():
     # Use this so that it can be mocked in tests without interfering with python
     # system machinery.
@@ -792,14 +844,23 @@ def _FilterYapfIgnoredFiles(filepaths, patterns):
     ]
 
 
+def _GetCommitCount(begin_commit: str, end_commit: str = "HEAD") -> int:
+    """Returns the number of commits in (begin_commit, end_commit].
+
+    Returns 0 if git can't resolve the range.
+    """
+    return int(
+        RunGitSilent(['rev-list', '--count', f'{begin_commit}..{end_commit}'])
+        or 0)
+
+
 def _GetCommitCountSummary(begin_commit: str,
                            end_commit: str = "HEAD") -> Optional[str]:
     """Generate a summary of the number of commits in (begin_commit, end_commit).
 
     Returns a string containing the summary, or None if the range is empty.
     """
-    count = int(
-        RunGitSilent(['rev-list', '--count', f'{begin_commit}..{end_commit}']))
+    count = _GetCommitCount(begin_commit, end_commit)
 
     if not count:
         return None
@@ -807,6 +868,25 @@ def _GetCommitCountSummary(begin_commit: str,
     return f'{count} commit{"s"[:count!=1]}'
 
 
+def _split_remote_url(url: Optional[str]) -> Tuple[str, str, str]:
+    """Splits a git remote URL into its (scheme, netloc, path) parts.
+
+    Remote URLs almost always use the https://, sso:// or ssh:// schemes, which
+    are split with plain string searches. Anything else falls back to urlparse.
+    """
+    if not url:
+        return '', '', ''
+    scheme_end = url.find('://')
+    scheme = url[:scheme_end] if scheme_end != -1 else ''
+    if scheme in ('https', 'sso', 'ssh') and '?' not in url and '#' not in url:
+        path_start = url.find('/', scheme_end + 3)
+        if path_start == -1:
+            return scheme, url[scheme_end + 3:], ''
+        return scheme, url[scheme_end + 3:path_start], url[path_start:]
+    parsed_url = urllib.parse.urlparse(url)
+    return parsed_url.scheme, parsed_url.netloc, parsed_url.path
+
+
 def _prepare_superproject_push_option() -> str | None:
     """Returns the push option specifying the root repo of a gclient checkout.
 
@@ -830,8 +910,43 @@ def _prepare_superproject_push_option() -> str | None:
     return f'custom-keyed-value=rootRepo:{host}/{project}'
 
 
-def print_stats(args):
-    """Prints statistics about the change to the user."""
+def _shorten_git_hashes(path):
+    """Rewrites the file at path keeping only the first 6 chars of git hashes.
+
+    The file is streamed line by line into a temporary file next to it, so
+    large traces are never held in memory.
+    """
+    with open(path, encoding='utf-8', errors='replace') as src, \
+            tempfile.NamedTemporaryFile('w',
+                                        encoding='utf-8',
+                                        dir=os.path.dirname(path),
+                                        delete=False) as dst:
+        for line in src:
+            dst.write(GIT_HASH_RE.sub(r'\1', line))
+    os.replace(dst.name, path)
+
+
+def _make_zip_archive(base_name, root_dir):
+    """Zips the files under root_dir into base_name.zip.
+
+    Like shutil.make_archive(base_name, 'zip', root_dir), but uses the fastest
+    deflate level since traces are small and mostly text.
+    """
+    with zipfile.ZipFile(base_name + '.zip',
+                         'w',
+                         zipfile.ZIP_DEFLATED,
+                         compresslevel=1) as zf:
+        for dirpath, _, filenames in os.walk(root_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                zf.write(path, os.path.relpath(path, root_dir))
+
+
+def start_stats(args):
+    """Starts computing statistics about the change, to be printed to the user.
+
+    Returns the git process. Its stdout and stderr are both piped.
+    """
     # --no-ext-diff is broken in some versions of Git, so try to work around
     # this by overriding the environment (but there is still a problem if the
     # git config key "diff.external" is used).
@@ -839,9 +954,18 @@ def print_stats(args):
     if 'GIT_EXTERNAL_DIFF' in env:
         del env['GIT_EXTERNAL_DIFF']
 
-    return subprocess2.call(
-        ['git', 'diff', '--no-ext-diff', '--stat', '-l100000', '-C50'] + args,
-        env=env)
+    cmd = ['git', 'diff', '--no-ext-diff', '--stat', '-l100000', '-C50']
+    # git can't tell the output ends up on a terminal once it is piped, so ask
+    # it whether the user's color.diff and color.ui settings want color there.
+    if setup_color.IS_TTY:
+        colorbool = RunGit(['config', '--get-colorbool', 'color.diff', 'true'],
+                           error_ok=True)
+        if colorbool.strip() == 'true':
+            cmd.append('--color')
+    return subprocess2.Popen(cmd + args,
+                             env=env,
+                             stdout=subprocess2.PIPE,
+                             stderr=subprocess2.PIPE)
 
 
 class BuildbucketResponseException(Exception):
@@ -861,6 +985,7 @@ class Settings(object):
         self.git_editor = None
         self.format_full_by_default = None
         self.is_status_commit_order_by_date = None
+        self.cache_change_details = None
 
     def _LazyUpdateIfNeeded(self):
         """Updates the settings from a codereview.settings file, if available."""
@@ -978,6 +1103,13 @@ class Settings(object):
                 'cl.date-order')
         return self.is_status_commit_order_by_date
 
+    def GetCacheChangeDetails(self):
+        """Returns True if Gerrit change details should be cached on disk."""
+        if self.cache_change_details is None:
+            self.cache_change_details = self._GetConfigBool(
+                'gerrit.cache-change-details')
+        return self.cache_change_details
+
     def _GetConfig(self, key, default=''):
         self._LazyUpdateIfNeeded()
         return scm.GIT.GetConfig(self.GetRoot(), key, default)
@@ -1109,6 +1241,85 @@ _NewUpload = collections.namedtuple('NewUpload', [
 ])
 
 
+class _ChangeDetailCache(object):
+    """On-disk cache of Gerrit change details, shared by git cl invocations.
+
+    Entries are keyed on (host, issue, options) and remember the ETag Gerrit
+    returned, so that a cached copy is revalidated with a conditional request
+    instead of being downloaded again.
+    """
+    def __init__(self, path=None):
+        self.path = path or os.path.join(os.path.expanduser('~'),
+                                         '.gitcl_cache', 'change_details.db')
+
+    # Paths whose schema has been set up by this process.
+    _prepared_paths = set()
+
+    def _Prepare(self):
+        """Creates the cache, readable only by the user, and its schema."""
+        cache_dir = os.path.dirname(self.path)
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        os.chmod(cache_dir, 0o700)
+        # The cache holds the details of private CLs. SQLite gives its -wal and
+        # -shm files the permissions of the database file.
+        os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.chmod(self.path + suffix, 0o600)
+            except FileNotFoundError:
+                pass
+        with contextlib.closing(sqlite3.connect(self.path, timeout=5)) as db:
+            # The journal mode is stored in the database file.
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS details ('
+                       'host TEXT, issue INTEGER, options TEXT, etag TEXT, '
+                       'data TEXT, mtime REAL, '
+                       'PRIMARY KEY (host, issue, options))')
+        self._prepared_paths.add(self.path)
+
+    def _Execute(self, *statements):
+        """Runs the (query, params) |statements| in a single transaction.
+
+        Returns the first row of the last statement, or None on any failure.
+        """
+        try:
+            if self.path not in self._prepared_paths:
+                self._Prepare()
+            with contextlib.closing(sqlite3.connect(self.path,
+                                                    timeout=5)) as db:
+                with db:
+                    row = None
+                    for query, params in statements:
+                        row = db.execute(query, params).fetchone()
+                    return row
+        except (OSError, sqlite3.Error) as e:
+            logging.debug('Change detail cache at %s is unusable: %s',
+                          self.path, e)
+            return None
+
+    def Get(self, host, issue, options_set):
+        """Returns the cached (etag, data) for the change, or (None, None)."""
+        row = self._Execute(('SELECT etag, data, mtime FROM details '
+                             'WHERE host = ? AND issue = ? AND options = ?',
+                             (host, issue, ','.join(sorted(options_set)))))
+        if not row or time_time() - row[2] > _CHANGE_DETAIL_CACHE_TTL_SECONDS:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def Put(self, host, issue, options_set, etag, data):
+        now = time_time()
+        self._Execute(
+            ('DELETE FROM details WHERE mtime < ?',
+             (now - _CHANGE_DETAIL_CACHE_TTL_SECONDS, )),
+            ('INSERT OR REPLACE INTO details VALUES (?, ?, ?, ?, ?, ?)',
+             (host, issue, ','.join(sorted(options_set)), etag,
+              json.dumps(data), now)))
+
+    def Invalidate(self, host, issue):
+        self._Execute(('DELETE FROM details WHERE host = ? AND issue = ?',
+                       (host, issue)))
+
+
 class ChangeDescription(object):
     """Contains a parsed form of the change description."""
     R_LINE = r'^[ \t]*(TBR|R)[ \t]*=[ \t]*(.*?)[ \t]*$'
@@ -1283,6 +1494,8 @@ class ChangeDescription(object):
             separator = [
             ]  # No need for separator if there are no gerrit_footers.
 
+        # presubmit_support is slow to import, so it is only loaded when needed.
+        import presubmit_support
         prev_line = top_lines[-1] if top_lines else ''
         if (not presubmit_support.Change.TAG_LINE_RE.match(prev_line)
                 or not presubmit_support.Change.TAG_LINE_RE.match(line)):
@@ -1378,13 +1591,22 @@ class Changelist(object):
         self.more_cc = []
         self._remote = None
         self._cached_remote_url = (False, None)  # (is_cached, value)
+        self._parsed_remote_url = None
+        # (is_cached, value)
+        self._cached_superproject_push_option = (False, None)
 
         # Lazily cached values.
         self._gerrit_host = None  # e.g. chromium-review.googlesource.com
         self._gerrit_server = None  # e.g. https://chromium-review.googlesource.com
+        self._gerrit_project = None  # e.g. chromium/src
         self._owners_client = None
+        self._gerrit_presubmit_args = None
+        # Map from (host, accounts) to the accounts Gerrit recognizes.
+        self._valid_accounts_cache = {}
         # Map from change number (issue) to its detail cache.
         self._detail_cache = {}
+        # Map from (change number, options set) to the detail cached for it.
+        self._detail_cache_exact = {}
 
         if codereview_host is not None:
             assert not codereview_host.startswith('https://'), codereview_host
@@ -1574,6 +1796,12 @@ class Changelist(object):
         self._cached_remote_url = (True, url)
         return url
 
+    def _GetParsedRemoteUrl(self) -> Tuple[str, str, str]:
+        """Returns (scheme, netloc, path) of GetRemoteUrl(), split only once."""
+        if self._parsed_remote_url is None:
+            self._parsed_remote_url = _split_remote_url(self.GetRemoteUrl())
+        return self._parsed_remote_url
+
     def _GetIssueFromTripletId(self):
         project = self.GetGerritProject()
         remote, branch = self.GetRemoteBranch()
@@ -1628,7 +1856,7 @@ class Changelist(object):
         assert self.GetIssue(), 'issue is required to query Gerrit'
 
         if self.description is None:
-            data = self._GetChangeDetail(['CURRENT_REVISION', 'CURRENT_COMMIT'])
+            data = self._GetChangeDetail(_CURRENT_REVISION_OPTS)
             current_rev = data['current_revision']
             self.description = data['revisions'][current_rev]['commit'][
                 'message']
@@ -1739,25 +1967,39 @@ class Changelist(object):
                                      self._GerritChangeIdentifier(),
                                      description,
                                      notify='NONE')
+        self._InvalidateChangeDetailCache()
 
         self.description = description
 
+    def _GetGerritPresubmitArgs(self):
+        """Returns the Gerrit url/project/branch presubmit args.
+
+        These are computed once per Changelist, since RunHook may be called
+        repeatedly (e.g. once per branch on multi-change uploads).
+        """
+        if self._gerrit_presubmit_args is None:
+            remote, remote_branch = self.GetRemoteBranch()
+            self._gerrit_presubmit_args = [
+                '--gerrit_url',
+                self.GetCodereviewServer(),
+                '--gerrit_project',
+                self.GetGerritProject(),
+                '--gerrit_branch',
+                GetTargetRef(remote, remote_branch, None),
+            ]
+        return self._gerrit_presubmit_args
+
     def _GetCommonPresubmitArgs(self, verbose, upstream):
         args = [
             '--root',
             settings.GetRoot(),
             '--upstream',
             upstream,
+            *(['--verbose'] * verbose),
         ]
 
-        args.extend(['--verbose'] * verbose)
-
-        remote, remote_branch = self.GetRemoteBranch()
-        target_ref = GetTargetRef(remote, remote_branch, None)
         if settings.GetIsGerrit():
-            args.extend(['--gerrit_url', self.GetCodereviewServer()])
-            args.extend(['--gerrit_project', self.GetGerritProject()])
-            args.extend(['--gerrit_branch', target_ref])
+            args += self._GetGerritPresubmitArgs()
 
         author = self.GetAuthor()
         issue = self.GetIssue()
@@ -1847,13 +2089,14 @@ class Changelist(object):
                 return json.loads(json_results)
 
     def RunPostUploadHook(self, verbose, upstream, description):
+        """Runs the post-upload hooks and returns their exit code."""
         args = self._GetCommonPresubmitArgs(verbose, upstream)
         args.append('--post_upload')
 
         with gclient_utils.temporary_file() as description_file:
             gclient_utils.FileWrite(description_file, description)
             args.extend(['--description_file', description_file])
-            subprocess2.Popen(['vpython3', PRESUBMIT_SUPPORT] + args).wait()
+            return subprocess2.call(['vpython3', PRESUBMIT_SUPPORT] + args)
 
     def _GetDescriptionForUpload(self, options: optparse.Values,
                                  git_diff_args: Sequence[str],
@@ -2120,7 +2363,7 @@ class Changelist(object):
         if self.GetIssue():
             if options.edit_description:
                 change_desc.prompt()
-            change_detail = self._GetChangeDetail(['CURRENT_REVISION'])
+            change_detail = self._GetChangeDetail(_CURRENT_REVISION_OPTS)
             change_id = change_detail['change_id']
             change_desc.ensure_change_id(change_id)
 
@@ -2215,19 +2458,31 @@ class Changelist(object):
         change_desc = self._GetDescriptionForUpload(options, git_diff_args,
                                                     files)
 
-        # For options.squash, RunHook is called once for each branch in
-        # PrepareChange().
-        if not options.bypass_hooks and not options.squash:
-            hook_results = self.RunHook(committing=False,
-                                        may_prompt=not options.force,
-                                        verbose=options.verbose,
-                                        parallel=options.parallel,
-                                        upstream=base_branch,
-                                        description=change_desc.description,
-                                        all_files=False)
-            self.ExtendCC(hook_results['more_cc'])
+        # The diff stats are only shown right before uploading, so compute them
+        # while the hooks run.
+        stats = start_stats(git_diff_args)
+        try:
+            # For options.squash, RunHook is called once for each branch in
+            # PrepareChange().
+            if not options.bypass_hooks and not options.squash:
+                hook_results = self.RunHook(
+                    committing=False,
+                    may_prompt=not options.force,
+                    verbose=options.verbose,
+                    parallel=options.parallel,
+                    upstream=base_branch,
+                    description=change_desc.description,
+                    all_files=False)
+                self.ExtendCC(hook_results['more_cc'])
+        except BaseException:
+            # The upload won't happen, so neither will the stats be shown.
+            stats.kill()
+            stats.communicate()
+            raise
+        stats_out, stats_err = stats.communicate()
+        sys.stderr.write(stats_err.decode('utf-8', 'replace'))
+        sys.stdout.write(stats_out.decode('utf-8', 'replace'))
 
-        print_stats(git_diff_args)
         ret = self.CMDUploadChange(options, git_diff_args, custom_cl_base,
                                    change_desc)
         if not ret:
@@ -2271,6 +2526,7 @@ class Changelist(object):
                                   self._GerritChangeIdentifier(),
                                   labels=labels,
                                   notify=notify)
+            self._InvalidateChangeDetailCache()
             return 0
         except KeyboardInterrupt:
             raise
@@ -2295,8 +2551,7 @@ class Changelist(object):
         if self._gerrit_host and '.' not in self._gerrit_host:
             # Abbreviated domain like "chromium" instead of
             # chromium.googlesource.com.
-            parsed = urllib.parse.urlparse(self.GetRemoteUrl())
-            if parsed.scheme == 'sso':
+            if self._GetParsedRemoteUrl()[0] == 'sso':
                 self._gerrit_host = '%s.googlesource.com' % self._gerrit_host
                 self._gerrit_server = 'https://%s' % self._gerrit_host
 
@@ -2304,20 +2559,19 @@ class Changelist(object):
 
     def _GetGitHost(self):
         """Returns git host to be used when uploading change to Gerrit."""
-        remote_url = self.GetRemoteUrl()
-        if not remote_url:
+        if not self.GetRemoteUrl():
             return None
-        return urllib.parse.urlparse(remote_url).netloc
+        return self._GetParsedRemoteUrl()[1]
 
     def _GetGerritHostFromRemoteUrl(self) -> str:
-        url = urllib.parse.urlparse(self.GetRemoteUrl())
-        parts = url.netloc.split('.')
+        scheme, netloc, _ = self._GetParsedRemoteUrl()
+        parts = netloc.split('.')
 
         # We assume repo to be hosted on Gerrit, and hence Gerrit server
         # has "-review" suffix for lowest level subdomain.
         parts[0] = parts[0] + '-review'
 
-        if url.scheme == 'sso' and len(parts) == 1:
+        if scheme == 'sso' and len(parts) == 1:
             # sso:// uses abbreivated hosts, eg. sso://chromium instead
             # of chromium.googlesource.com. Hence, for code review
             # server, they need to be expanded.
@@ -2342,20 +2596,19 @@ class Changelist(object):
 
     def GetGerritProject(self):
         """Returns Gerrit project name based on remote git URL."""
-        remote_url = self.GetRemoteUrl()
-        if remote_url is None:
+        if self._gerrit_project is not None:
+            return self._gerrit_project
+        if self.GetRemoteUrl() is None:
             logging.warning('can\'t detect Gerrit project.')
             return None
-        project = urllib.parse.urlparse(remote_url).path.strip('/')
-        if project.endswith('.git'):
-            project = project[:-len('.git')]
         # *.googlesource.com hosts ensure that Git/Gerrit projects don't start
         # with 'a/' prefix, because 'a/' prefix is used to force authentication
         # in gitiles/git-over-https protocol. E.g.,
         # https://chromium.googlesource.com/a/v8/v8 refers to the same
         # repo/project as https://chromium.googlesource.com/v8/v8
-        if project.startswith('a/'):
-            project = project[len('a/'):]
+        project = self._GetParsedRemoteUrl()[2].strip('/').removesuffix(
+            '.git').removeprefix('a/')
+        self._gerrit_project = project
         return project
 
     def _GerritChangeIdentifier(self):
@@ -2382,11 +2635,11 @@ class Changelist(object):
             logging.warning('invalid remote')
             return
 
-        parsed_url = urllib.parse.urlparse(remote_url)
-        if parsed_url.scheme == 'sso':
+        scheme = self._GetParsedRemoteUrl()[0]
+        if scheme == 'sso':
             # Skip checking authentication for projects with sso:// scheme.
             return
-        if parsed_url.scheme != 'https':
+        if scheme != 'https':
             logging.warning(
                 'Ignoring branch %(branch)s with non-https remote '
                 '%(remote)s', {
@@ -2458,16 +2711,17 @@ class Changelist(object):
 
         # If the issue owner is one of the emails for the currently
         # authenticated account, Gerrit will accept the upload.
-        if any(owner == e['email'] for e in emails):
+        email_map = {e['email']: e for e in emails}
+        if owner in email_map:
             return
 
         if not force:
             print(
                 f'WARNING: Change {issue} is owned by {owner}, but Gerrit knows you as:'
             )
-            for email in emails:
+            for address, email in email_map.items():
                 tag = ' (preferred)' if email.get('preferred') else ''
-                print(f'  * {email["email"]}{tag}')
+                print(f'  * {address}{tag}')
             print('Uploading may fail due to lack of permissions.')
             confirm_or_exit(action='upload')
 
@@ -2489,8 +2743,7 @@ class Changelist(object):
             return None
 
         try:
-            data = self._GetChangeDetail(
-                ['DETAILED_LABELS', 'CURRENT_REVISION', 'SUBMITTABLE'])
+            data = self._GetChangeDetail(_STATUS_OPTS)
         except GerritChangeNotExists:
             return 'error'
 
@@ -2500,7 +2753,12 @@ class Changelist(object):
         cq_label = data['labels'].get('Commit-Queue', {})
         max_cq_vote = 0
         for vote in cq_label.get('all', []):
-            max_cq_vote = max(max_cq_vote, vote.get('value', 0))
+            value = vote.get('value', 0)
+            if value > max_cq_vote:
+                max_cq_vote = value
+                if value == 2:
+                    # Commit-Queue+2 is the highest possible vote.
+                    break
         if max_cq_vote == 2:
             return 'commit'
         if max_cq_vote == 1:
@@ -2514,10 +2772,8 @@ class Changelist(object):
 
         owner = data['owner'].get('_account_id')
         messages = sorted(data.get('messages', []), key=lambda m: m.get('date'))
-        while messages:
-            m = messages.pop()
-            if (m.get('tag', '').startswith('autogenerated:cq')
-                    or m.get('tag', '').startswith('autogenerated:cv')):
+        for m in reversed(messages):
+            if m.get('tag', '').startswith(_AUTOGEN_CQ_CV):
                 # Ignore replies from LUCI CV/CQ.
                 continue
             if m.get('author', {}).get('_account_id') == owner:
@@ -2534,7 +2790,7 @@ class Changelist(object):
         if not self.GetIssue():
             return None
 
-        data = self._GetChangeDetail(['CURRENT_REVISION'])
+        data = self._GetChangeDetail(_CURRENT_REVISION_OPTS)
         patchset = data['revisions'][data['current_revision']]['_number']
         if update:
             self.SetPatchset(patchset)
@@ -2546,15 +2802,16 @@ class Changelist(object):
         if not self.GetIssue():
             return False
 
-        data = self._GetChangeDetail(['ALL_REVISIONS'])
-        ps_kind = {}
+        data = self._GetChangeDetail(_ALL_REVISIONS_OPTS)
+        in_range = 0
         for rev_info in data.get('revisions', {}).values():
-            ps_kind[rev_info['_number']] = rev_info.get('kind', '')
-
-        for ps in range(lower, upper + 1):
-            assert ps in ps_kind, 'expected patchset %d in change detail' % ps
-            if ps_kind[ps] not in ('NO_CHANGE', 'NO_CODE_CHANGE'):
-                return True
+            if lower <= rev_info['_number'] <= upper:
+                if rev_info.get('kind', '') not in ('NO_CHANGE',
+                                                    'NO_CODE_CHANGE'):
+                    return True
+                in_range += 1
+        assert in_range == upper - lower + 1, (
+            'expected patchsets %d-%d in change detail' % (lower, upper))
         return False
 
     def GetMostRecentDryRunPatchset(self):
@@ -2564,7 +2821,7 @@ class Changelist(object):
         if not self.GetIssue():
             return None
 
-        data = self._GetChangeDetail(['ALL_REVISIONS'])
+        data = self._GetChangeDetail(_ALL_REVISIONS_OPTS)
         patchset = data['revisions'][data['current_revision']]['_number']
         dry_run = {
             int(m['_revision_number'])
@@ -2572,15 +2829,20 @@ class Changelist(object):
             if m.get('tag', '').endswith('dry-run')
         }
 
-        for revision_info in sorted(data.get('revisions', {}).values(),
-                                    key=lambda c: c['_number'],
-                                    reverse=True):
-            if revision_info['_number'] in dry_run:
-                patchset = revision_info['_number']
-                break
+        # Walking down from the newest patchset, stop at the first one that was
+        # dry run or that is not equivalent to its predecessor.
+        last_significant = -1
+        dry_run_candidates = []
+        for revision_info in data.get('revisions', {}).values():
+            number = revision_info['_number']
+            if number in dry_run:
+                dry_run_candidates.append(number)
             if revision_info.get('kind', '') not in \
                 ('NO_CHANGE', 'NO_CODE_CHANGE', 'TRIVIAL_REBASE'):
-                break
+                last_significant = max(last_significant, number)
+        patchset = max(
+            (n for n in dry_run_candidates if n >= last_significant),
+            default=patchset)
         self.SetPatchset(patchset)
         return patchset
 
@@ -2589,22 +2851,32 @@ class Changelist(object):
                               self._GerritChangeIdentifier(),
                               msg=message,
                               ready=publish)
+        self._InvalidateChangeDetailCache()
 
     def GetCommentsSummary(self, readable=True):
-        # DETAILED_ACCOUNTS is to get emails in accounts.
-        # CURRENT_REVISION is included to get the latest patchset so that
-        # only the robot comments from the latest patchset can be shown.
-        messages = self._GetChangeDetail(
-            options=['MESSAGES', 'DETAILED_ACCOUNTS', 'CURRENT_REVISION']).get(
-                'messages', [])
-        file_comments = gerrit_util.GetChangeComments(
-            self.GetGerritHost(), self._GerritChangeIdentifier())
-        robot_file_comments = gerrit_util.GetChangeRobotComments(
-            self.GetGerritHost(), self._GerritChangeIdentifier())
+        host = self.GetGerritHost()
+        change = self._GerritChangeIdentifier()
+        # The RPCs below are independent, so issue them concurrently.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            # DETAILED_ACCOUNTS is to get emails in accounts.
+            # CURRENT_REVISION is included to get the latest patchset so that
+            # only the robot comments from the latest patchset can be shown.
+            detail = executor.submit(
+                self._GetChangeDetail,
+                options=['MESSAGES', 'DETAILED_ACCOUNTS', 'CURRENT_REVISION'])
+            file_comments = executor.submit(gerrit_util.GetChangeComments,
+                                            host, change)
+            robot_file_comments = executor.submit(
+                gerrit_util.GetChangeRobotComments, host, change)
+        detail = detail.result()
+        messages = detail.get('messages', [])
+        file_comments = file_comments.result()
+        robot_file_comments = robot_file_comments.result()
 
         # Add the robot comments onto the list of comments, but only
         # keep those that are from the latest patchset.
-        latest_patch_set = self.GetMostRecentPatchset()
+        latest_patch_set = detail['revisions'][
+            detail['current_revision']]['_number']
         for path, robot_comments in robot_file_comments.items():
             line_comments = file_comments.setdefault(path, [])
             line_comments.extend([
@@ -2612,9 +2884,8 @@ class Changelist(object):
             ])
 
         # Build dictionary of file comments for easy access and sorting later.
-        # {author+date: {path: {patchset: {line: url+message}}}}
-        comments = collections.defaultdict(lambda: collections.defaultdict(
-            lambda: collections.defaultdict(dict)))
+        # {author+date: {(path, patchset, line): url+message}}
+        comments = {}
 
         server = self.GetCodereviewServer()
         if server in _KNOWN_GERRIT_TO_SHORT_URLS:
@@ -2631,16 +2902,14 @@ class Changelist(object):
                         'autogenerated') and 'robot_id' not in comment:
                     continue
                 key = (comment['author']['email'], comment['updated'])
-                if comment.get('side', 'REVISION') == 'PARENT':
-                    patchset = 'Base'
-                else:
-                    patchset = 'PS%d' % comment['patch_set']
+                ps_number = comment['patch_set']
+                is_parent = comment.get('side') == 'PARENT'
+                patchset = 'Base' if is_parent else 'PS%d' % ps_number
                 line = comment.get('line', 0)
-                url = ('%s/%s/%s#%s%s' %
-                       (url_prefix, comment['patch_set'],
-                        path, 'b' if comment.get('side') == 'PARENT' else '',
-                        str(line) if line else ''))
-                comments[key][path][patchset][line] = (url, comment['message'])
+                url = (f"{url_prefix}/{ps_number}/{path}#"
+                       f"{'b' if is_parent else ''}{line or ''}")
+                comments.setdefault(key, {})[path, patchset, line] = (
+                    url, comment['message'])
 
         summaries = []
         for msg in messages:
@@ -2665,27 +2934,31 @@ class Changelist(object):
         message = msg['message']
         # Gerrit spits out nanoseconds.
         assert len(msg['date'].split('.')[-1]) == 9
-        date = datetime.datetime.strptime(msg['date'][:-3],
-                                          '%Y-%m-%d %H:%M:%S.%f')
+        try:
+            date = datetime.datetime.fromisoformat(msg['date'][:-3])
+        except ValueError:
+            date = datetime.datetime.strptime(msg['date'][:-3],
+                                              '%Y-%m-%d %H:%M:%S.%f')
         if key in comments:
             message += '\n'
-        for path, patchsets in sorted(comments.get(key, {}).items()):
-            if readable:
+        last_path = None
+        for (path, patchset,
+             line), (url, content) in sorted(comments.get(key, {}).items()):
+            if readable and path != last_path:
                 message += '\n%s' % path
-            for patchset, lines in sorted(patchsets.items()):
-                for line, (url, content) in sorted(lines.items()):
-                    if line:
-                        line_str = 'Line %d' % line
-                        path_str = '%s:%d:' % (path, line)
-                    else:
-                        line_str = 'File comment'
-                        path_str = '%s:0:' % path
-                    if readable:
-                        message += '\n  %s, %s: %s' % (patchset, line_str, url)
-                        message += '\n  %s\n' % content
-                    else:
-                        message += '\n%s ' % path_str
-                        message += '\n%s\n' % content
+                last_path = path
+            if line:
+                line_str = 'Line %d' % line
+                path_str = '%s:%d:' % (path, line)
+            else:
+                line_str = 'File comment'
+                path_str = '%s:0:' % path
+            if readable:
+                message += '\n  %s, %s: %s' % (patchset, line_str, url)
+                message += '\n  %s\n' % content
+            else:
+                message += '\n%s ' % path_str
+                message += '\n%s\n' % content
 
         return _CommentSummary(
             date=date,
@@ -2703,23 +2976,37 @@ class Changelist(object):
         gerrit_util.AbandonChange(self.GetGerritHost(),
                                   self._GerritChangeIdentifier(),
                                   msg='')
+        self._InvalidateChangeDetailCache()
 
     def SubmitIssue(self):
         gerrit_util.SubmitChange(self.GetGerritHost(),
                                  self._GerritChangeIdentifier())
+        self._InvalidateChangeDetailCache()
 
     def _GetChangeDetail(self, options=None):
-        """Returns details of associated Gerrit change and caching results."""
-        options = options or []
-        assert self.GetIssue(), 'issue is required to query Gerrit'
+        """Returns details of associated Gerrit change and caching results.
 
-        # Optimization to avoid multiple RPCs:
-        if 'CURRENT_REVISION' in options or 'ALL_REVISIONS' in options:
-            options.append('CURRENT_COMMIT')
+        options is a list of option names, or a frozenset of upper-case option
+        names (like _STATUS_OPTS) which is used as is.
+        """
+        assert self.GetIssue(), 'issue is required to query Gerrit'
 
         # Normalize issue and options for consistent keys in cache.
         cache_key = str(self.GetIssue())
-        options_set = frozenset(o.upper() for o in options)
+        if isinstance(options, frozenset):
+            options_set = options
+        else:
+            options_set = frozenset(o.upper() for o in options or [])
+
+        # Optimization to avoid multiple RPCs:
+        if (('CURRENT_REVISION' in options_set
+             or 'ALL_REVISIONS' in options_set)
+                and 'CURRENT_COMMIT' not in options_set):
+            options_set |= {'CURRENT_COMMIT'}
+
+        exact_key = (cache_key, options_set)
+        if exact_key in self._detail_cache_exact:
+            return self._detail_cache_exact[exact_key]
 
         for cached_options_set, data in self._detail_cache.get(cache_key, []):
             # Assumption: data fetched before with extra options is suitable
@@ -2729,12 +3016,11 @@ class Changelist(object):
             #   and request is for options=[CURRENT_REVISION],
             # THEN we can return prior cached data.
             if options_set.issubset(cached_options_set):
+                self._detail_cache_exact[exact_key] = data
                 return data
 
         try:
-            data = gerrit_util.GetChangeDetail(self.GetGerritHost(),
-                                               self._GerritChangeIdentifier(),
-                                               options_set)
+            data = self._FetchChangeDetail(options_set)
         except gerrit_util.GerritError as e:
             if e.http_status == 404:
                 raise GerritChangeNotExists(self.GetIssue(),
@@ -2742,8 +3028,34 @@ class Changelist(object):
             raise
 
         self._detail_cache.setdefault(cache_key, []).append((options_set, data))
+        self._detail_cache_exact[exact_key] = data
         return data
 
+    def _FetchChangeDetail(self, options_set):
+        """Fetches change details from Gerrit, using the on-disk cache if it is
+        enabled."""
+        host = self.GetGerritHost()
+        change = self._GerritChangeIdentifier()
+        if not settings.GetCacheChangeDetails():
+            return gerrit_util.GetChangeDetail(host, change, options_set)
+
+        cache = _ChangeDetailCache()
+        cached_etag, cached_data = cache.Get(host, self.GetIssue(),
+                                             options_set)
+        etag, data = gerrit_util.GetChangeDetailIfModified(
+            host, change, sorted(options_set), cached_etag)
+        if data is None:
+            return cached_data
+        if etag:
+            cache.Put(host, self.GetIssue(), options_set, etag, data)
+        return data
+
+    def _InvalidateChangeDetailCache(self):
+        """Drops the on-disk copies of this change's details after a write."""
+        if settings.GetCacheChangeDetails():
+            _ChangeDetailCache().Invalidate(self.GetGerritHost(),
+                                            self.GetIssue())
+
     def _GetChangeCommit(self, revision: str = 'current') -> dict:
         assert self.GetIssue(), 'issue must be set to query Gerrit'
         try:
@@ -2774,8 +3086,12 @@ class Changelist(object):
         differs = True
         last_upload = self._GitGetBranchConfigValue(
             GERRIT_SQUASH_HASH_CONFIG_KEY)
-        # Note: git diff outputs nothing if there is no diff.
-        if not last_upload or RunGit(['diff', last_upload]).strip():
+        # The tree is known to be clean, so there is nothing to diff if HEAD is
+        # the last uploaded commit.
+        # Note: git diff --quiet exits with 0 only if there is no diff.
+        if not last_upload or (
+                last_upload != scm.GIT.ResolveCommit(settings.GetRoot(), 'HEAD')
+                and RunGitWithCode(['diff', '--quiet', last_upload])[0]):
             print(
                 'WARNING: Some changes from local branch haven\'t been uploaded.'
             )
@@ -2829,7 +3145,7 @@ class Changelist(object):
             self._gerrit_server = 'https://%s' % self._gerrit_host
 
         try:
-            detail = self._GetChangeDetail(['ALL_REVISIONS'])
+            detail = self._GetChangeDetail(_ALL_REVISIONS_OPTS)
         except GerritChangeNotExists as e:
             DieWithError(str(e))
 
@@ -2929,14 +3245,18 @@ class Changelist(object):
     def _CleanUpOldTraces(self):
         """Keep only the last |MAX_TRACES| traces."""
         try:
-            traces = sorted([
-                os.path.join(TRACES_DIR, f) for f in os.listdir(TRACES_DIR)
-                if (os.path.isfile(os.path.join(TRACES_DIR, f))
-                    and not f.startswith('tmp'))
-            ])
+            # Trace names start with a timestamp, so sorting by name sorts them
+            # from oldest to newest.
+            with os.scandir(TRACES_DIR) as it:
+                traces = sorted(entry.path for entry in it
+                                if entry.is_file()
+                                and not entry.name.startswith('tmp'))
             traces_to_delete = traces[:-MAX_TRACES]
             for trace in traces_to_delete:
-                os.remove(trace)
+                try:
+                    os.remove(trace)
+                except FileNotFoundError:
+                    pass
         except OSError:
             print('WARNING: Failed to remove old git traces from\n'
                   '  %s'
@@ -2963,10 +3283,8 @@ class Changelist(object):
         # trace. This greatly decreases size after compression.
         packet_traces = os.path.join(traces_dir, 'trace-packet')
         if os.path.isfile(packet_traces):
-            contents = gclient_utils.FileRead(packet_traces)
-            gclient_utils.FileWrite(packet_traces,
-                                    GIT_HASH_RE.sub(r'\1', contents))
-        shutil.make_archive(traces_zip, 'zip', traces_dir)
+            _shorten_git_hashes(packet_traces)
+        _make_zip_archive(traces_zip, traces_dir)
 
         # Collect and compress the git config and gitcookies.
         git_config = '\n'.join(
@@ -2979,16 +3297,33 @@ class Changelist(object):
         gclient_utils.FileWrite(
             os.path.join(git_info_dir, f'{auth_name}.debug_summary_state'),
             debug_state)
-        shutil.make_archive(git_info_zip, 'zip', git_info_dir)
+        _make_zip_archive(git_info_zip, git_info_dir)
 
         gclient_utils.rmtree(git_info_dir)
 
+    def _GetSuperprojectPushOption(self):
+        """Returns _prepare_superproject_push_option(), computing it only once.
+
+        Finding it reads the .gclient files of the checkout, and retried or
+        stacked uploads push more than once.
+        """
+        is_cached, value = self._cached_superproject_push_option
+        if not is_cached:
+            value = _prepare_superproject_push_option()
+            self._cached_superproject_push_option = (True, value)
+        return value
+
     def _RunGitPushWithTraces(self,
                               refspec,
                               refspec_opts,
                               git_push_metadata,
-                              git_push_options=None):
-        """Run git push and collect the traces resulting from the execution."""
+                              git_push_options=None,
+                              change_numbers=None):
+        """Run git push and collect the traces resulting from the execution.
+
+        If change_numbers is a list, the numbers of the Gerrit changes created
+        or updated by the push are appended to it while the output streams in.
+        """
         # Create a temporary directory to store traces in. Traces will be
         # compressed and stored in a 'traces' dir inside depot_tools.
         traces_dir = tempfile.mkdtemp()
@@ -3011,7 +3346,7 @@ class Changelist(object):
             all_push_options = []
             if git_push_options:
                 all_push_options.extend(git_push_options)
-            if superproject_option := _prepare_superproject_push_option():
+            if superproject_option := self._GetSuperprojectPushOption():
                 all_push_options.append(superproject_option)
 
             remote_url = self.GetRemoteUrl()
@@ -3020,18 +3355,23 @@ class Changelist(object):
                 for opt in all_push_options:
                     push_cmd.extend(['-o', opt])
 
+            # Flush after every line: useful for seeing progress when running
+            # as recipe. The bound method is looked up once, not per line.
+            flush_stdout = sys.stdout.flush
+
+            def filter_fn(line):
+                flush_stdout()
+                if change_numbers is not None:
+                    m = _GERRIT_CHANGE_URL_RE.match(line)
+                    if m:
+                        change_numbers.append(m.group(1))
+
             push_stdout = gclient_utils.CheckCallAndFilter(
-                push_cmd,
-                env=env,
-                print_stdout=True,
-                # Flush after every line: useful for seeing progress when
-                # running as recipe.
-                filter_fn=lambda _: sys.stdout.flush())
-            push_stdout = push_stdout.decode('utf-8', 'replace')
+                push_cmd, env=env, print_stdout=True, filter_fn=filter_fn)
         except subprocess2.CalledProcessError as e:
             push_returncode = e.returncode
-            if 'blocked keyword' in str(e.stdout) or 'banned word' in str(
-                    e.stdout):
+            push_output = e.stdout or b''
+            if b'blocked keyword' in push_output or b'banned word' in push_output:
                 raise GitPushError(
                     'Failed to create a change, very likely due to blocked keyword. '
                     'Please examine output above for the reason of the failure.\n'
@@ -3041,7 +3381,7 @@ class Changelist(object):
                     'git cl upload -o banned-words~skip\n\n'
                     'If git-cl is not working correctly, file a bug under the '
                     'Infra>SDK component.')
-            if 'git push -o nokeycheck' in str(e.stdout):
+            if b'git push -o nokeycheck' in push_output:
                 raise GitPushError(
                     'Failed to create a change, very likely due to a private key being '
                     'detected. Please examine output above for the reason of the '
@@ -3084,13 +3424,37 @@ class Changelist(object):
 
             git_push_metadata['execution_time'] = execution_time
             git_push_metadata['exit_code'] = push_returncode
-            self._WriteGitPushTraces(trace_name, traces_dir, git_push_metadata)
+            if push_returncode:
+                # The error message points at the traces, so make sure they
+                # exist before it is shown.
+                self._FinalizeGitPushTraces(trace_name, traces_dir,
+                                            git_push_metadata)
+            else:
+                # Storing the traces is only disk I/O, so don't make the rest
+                # of the upload wait for it.
+                run_in_background(self._FinalizeGitPushTraces, trace_name,
+                                  traces_dir, git_push_metadata)
+
+        return push_stdout
 
+    def _FinalizeGitPushTraces(self, trace_name, traces_dir, git_push_metadata):
+        """Stores the traces in traces_dir, then removes old and temp ones."""
+        with _GIT_PUSH_TRACES_LOCK:
+            self._WriteGitPushTraces(trace_name, traces_dir, git_push_metadata)
             self._CleanUpOldTraces()
+        # Only the trace files git push wrote are expected in traces_dir, so
+        # remove them by name rather than walking the directory.
+        for name in GIT_PUSH_TRACE_FILES:
+            try:
+                os.remove(os.path.join(traces_dir, name))
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(traces_dir)
+        except OSError:
+            # Something else was left behind.
             gclient_utils.rmtree(traces_dir)
 
-        return push_stdout
-
     def CMDUploadChange(self, options, git_diff_args, custom_cl_base,
                         change_desc):
         """Upload the current branch to Gerrit, retry if new remote HEAD is
@@ -3107,15 +3471,31 @@ class Changelist(object):
             if remote_branch not in [DEFAULT_OLD_BRANCH, DEFAULT_NEW_BRANCH]:
                 DieWithError(str(e), change_desc)
 
-            project_head = gerrit_util.GetProjectHead(self._gerrit_host,
-                                                      self.GetGerritProject())
-            if project_head == branch:
-                DieWithError(str(e), change_desc)
+            # Fetch the remote state while asking Gerrit for the project
+            # HEAD. It is only needed if the upload is retried, so the fetch
+            # is stopped right away otherwise.
+            fetch_cmd = ['git', 'fetch', '--prune', remote]
+            fetch = subprocess2.Popen(fetch_cmd,
+                                      env=GetNoGitPagerEnv(),
+                                      stdout=subprocess2.PIPE)
+            try:
+                project_head = gerrit_util.GetProjectHead(
+                    self._gerrit_host, self.GetGerritProject())
+                if project_head == branch:
+                    DieWithError(str(e), change_desc)
+            except BaseException:
+                fetch.kill()
+                fetch.communicate()
+                raise
             branch = project_head
 
-        print("WARNING: Fetching remote state and retrying upload to default "
-              "branch...")
-        RunGit(['fetch', '--prune', remote])
+            print("WARNING: Fetching remote state and retrying upload to "
+                  "default branch...")
+            fetch_out, _ = fetch.communicate()
+            if fetch.returncode:
+                DieWithError('Command "%s" failed.\n%s' %
+                             (' '.join(fetch_cmd),
+                              fetch_out.decode('utf-8', 'replace')))
         options.edit_description = False
         options.force = True
         try:
@@ -3135,7 +3515,7 @@ class Changelist(object):
                 # User requested to change description
                 if options.edit_description:
                     change_desc.prompt()
-                change_detail = self._GetChangeDetail(['CURRENT_REVISION'])
+                change_detail = self._GetChangeDetail(_CURRENT_REVISION_OPTS)
                 change_id = change_detail['change_id']
                 change_desc.ensure_change_id(change_id)
 
@@ -3165,11 +3545,10 @@ class Changelist(object):
                 remote, upstream_branch, custom_cl_base, options.force,
                 change_desc)
             tree = RunGit(['rev-parse', 'HEAD:']).strip()
-            with gclient_utils.temporary_file() as desc_tempfile:
-                gclient_utils.FileWrite(desc_tempfile, change_desc.description)
-                ref_to_push = RunGit(
-                    ['commit-tree', tree, '-p', parent, '-F',
-                     desc_tempfile]).strip()
+            # git commit-tree reads the commit message from stdin.
+            ref_to_push = RunGit(
+                ['commit-tree', tree, '-p', parent],
+                stdin=change_desc.description.encode('utf-8')).strip()
         else:  # if not options.squash
             if options.no_add_changeid:
                 pass
@@ -3194,12 +3573,11 @@ class Changelist(object):
             change_id = change_id_candidates[0]
 
         SaveDescriptionBackup(change_desc)
-        commits = RunGitSilent(['rev-list',
-                                '%s..%s' % (parent, ref_to_push)]).splitlines()
-        if len(commits) > 1:
+        num_commits = _GetCommitCount(parent, ref_to_push)
+        if num_commits > 1:
             print(
                 'WARNING: This will upload %d commits. Run the following command '
-                'to see which commits will be uploaded: ' % len(commits))
+                'to see which commits will be uploaded: ' % num_commits)
             print('git log %s..%s' % (parent, ref_to_push))
             print('You can also use `git squash-branch` to squash these into a '
                   'single commit.')
@@ -3215,45 +3593,35 @@ class Changelist(object):
         # Add cc's from the --cc flag.
         if options.cc:
             cc.extend(options.cc)
-        cc = [email.strip() for email in cc if email.strip()]
-        if change_desc.get_cced():
-            cc.extend(change_desc.get_cced())
-        if self.GetGerritHost() == 'chromium-review.googlesource.com':
-            valid_accounts = set(reviewers + cc)
-            # TODO(crbug/877717): relax this for all hosts.
-        else:
-            valid_accounts = gerrit_util.ValidAccounts(self.GetGerritHost(),
-                                                       reviewers + cc)
-        logging.info('accounts %s are recognized, %s invalid',
-                     sorted(valid_accounts),
-                     set(reviewers + cc).difference(set(valid_accounts)))
+        cc = [email for email in (e.strip() for e in cc) if email]
+        cc.extend(change_desc.get_cced())
+        accounts = reviewers + cc
+        valid_accounts = self._GetValidAccounts(accounts)
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info('accounts %s are recognized, %s invalid',
+                         sorted(valid_accounts),
+                         set(accounts).difference(valid_accounts))
 
         # Extra options that can be specified at push time. Doc:
         # https://gerrit-review.googlesource.com/Documentation/user-upload.html
         refspec_opts = self._GetRefSpecOptions(options, change_desc)
 
-        for r in sorted(reviewers):
+        for r in reviewers:
             if r in valid_accounts:
                 refspec_opts.append('r=%s' % r)
-                reviewers.remove(r)
             else:
                 # TODO(tandrii): this should probably be a hard failure.
                 print(
                     'WARNING: reviewer %s doesn\'t have a Gerrit account, skipping'
                     % r)
-        for c in sorted(cc):
-            # refspec option will be rejected if cc doesn't correspond to an
-            # account, even though REST call to add such arbitrary cc may
-            # succeed.
-            if c in valid_accounts:
-                refspec_opts.append('cc=%s' % c)
-                cc.remove(c)
-
-        refspec_suffix = ''
-        if refspec_opts:
-            refspec_suffix = '%' + ','.join(refspec_opts)
-            assert ' ' not in refspec_suffix, (
-                'spaces not allowed in refspec: "%s"' % refspec_suffix)
+        reviewers = [r for r in reviewers if r not in valid_accounts]
+        # refspec option will be rejected if cc doesn't correspond to an
+        # account, even though REST call to add such arbitrary cc may succeed.
+        refspec_opts.extend('cc=%s' % c for c in sorted(cc)
+                            if c in valid_accounts)
+        cc = [c for c in cc if c not in valid_accounts]
+
+        refspec_suffix = _BuildRefSpecSuffix(refspec_opts)
         refspec = '%s:refs/for/%s%s' % (ref_to_push, branch, refspec_suffix)
 
         git_push_metadata = {
@@ -3268,16 +3636,14 @@ class Changelist(object):
         # increment later.
         latest_ps = self.GetMostRecentPatchset(update=False) or 0
 
-        push_stdout = self._RunGitPushWithTraces(refspec, refspec_opts,
-                                                 git_push_metadata,
-                                                 options.push_options)
+        change_numbers = []
+        self._RunGitPushWithTraces(refspec,
+                                   refspec_opts,
+                                   git_push_metadata,
+                                   options.push_options,
+                                   change_numbers=change_numbers)
 
         if options.squash:
-            regex = re.compile(r'remote:\s+https?://[\w\-\.\+\/#]*/(\d+)\s.*')
-            change_numbers = [
-                m.group(1) for m in map(regex.match, push_stdout.splitlines())
-                if m
-            ]
             if len(change_numbers) != 1:
                 DieWithError((
                     'Created|Updated %d issues on Gerrit, but only 1 expected.\n'
@@ -3300,6 +3666,22 @@ class Changelist(object):
 
         return 0
 
+    def _GetValidAccounts(self, accounts):
+        """Returns the accounts recognized by Gerrit.
+
+        Results are cached, so a retried upload doesn't look up the same
+        accounts again.
+        """
+        host = self.GetGerritHost()
+        if host == 'chromium-review.googlesource.com':
+            # TODO(crbug/877717): relax this for all hosts.
+            return frozenset(accounts)
+        key = (host, frozenset(accounts))
+        if key not in self._valid_accounts_cache:
+            self._valid_accounts_cache[key] = frozenset(
+                gerrit_util.ValidAccounts(host, accounts))
+        return self._valid_accounts_cache[key]
+
     def _ComputeParent(self, remote, upstream_branch, custom_cl_base, force,
                        change_desc):
         """Computes parent of the generated commit to be uploaded to Gerrit.
@@ -3355,8 +3737,10 @@ class Changelist(object):
                                          GERRIT_SQUASH_HASH_CONFIG_KEY)
         # Verify that the upstream branch has been uploaded too, otherwise
         # Gerrit will create additional CLs when uploading.
-        if not parent or (RunGitSilent(['rev-parse', upstream_branch + ':']) !=
-                          RunGitSilent(['rev-parse', parent + ':'])):
+        if parent:
+            upstream_tree, parent_tree = ResolveGitObjects(
+                [upstream_branch + ':', parent + ':'])
+        if not parent or not parent_tree or upstream_tree != parent_tree:
             DieWithError(
                 '\nUpload upstream branch %s first.\n'
                 'It is likely that this branch has been rebased since its last '
@@ -3389,18 +3773,17 @@ class Changelist(object):
               (num_changes, change_words, self.GetIssueURL(short=True)))
 
         # Print an overview of external changes.
-        ps_to_commit = {}
-        ps_to_info = {}
-        revisions = self._GetChangeDetail(['ALL_REVISIONS'])
-        for commit_id, revision_info in revisions.get('revisions', {}).items():
-            ps_num = revision_info['_number']
-            ps_to_commit[ps_num] = commit_id
-            ps_to_info[ps_num] = revision_info
+        revisions = self._GetChangeDetail(_ALL_REVISIONS_OPTS)
+        ps_to_pair = {
+            revision_info['_number']:
+            (commit_id, revision_info.get('description', ''))
+            for commit_id, revision_info in revisions.get('revisions',
+                                                          {}).items()
+        }
 
         for ps in range(external_ps, local_ps, -1):
-            commit = ps_to_commit[ps][:8]
-            desc = ps_to_info[ps].get('description', '')
-            print('Patchset %d [%s] %s' % (ps, commit, desc))
+            commit, desc = ps_to_pair[ps]
+            print('Patchset %d [%s] %s' % (ps, commit[:8], desc))
 
         print('\nSee diff at: %s/%d..%d' %
               (self.GetIssueURL(short=True), local_ps, external_ps))
@@ -3410,10 +3793,12 @@ class Changelist(object):
             return
 
         # Get latest Gerrit merge base. Use the first parent even if multiple
-        # exist.
-        external_parent: dict = self._GetChangeCommit(
-            revision=external_ps)['parents'][0]
-        external_base: str = external_parent['commit']
+        # exist. The change detail above already holds the current revision's
+        # commit, so this normally doesn't need another request.
+        external_commit: dict = (
+            revisions['revisions'][ps_to_pair[external_ps][0]].get('commit')
+            or self._GetChangeCommit(revision=external_ps))
+        external_base: str = external_commit['parents'][0]['commit']
 
         branch = git_common.current_branch()
         local_base = self.GetCommonAncestorWithUpstream()
@@ -3441,19 +3826,24 @@ class Changelist(object):
                 'Continue with upload and override the latest changes?')
             return
 
-        # Fetch Gerrit's CL base if it doesn't exist locally.
+        # Fetch Gerrit's CL base if it doesn't exist locally. This is kept
+        # separate from the patchset fetch below, since servers may refuse to
+        # serve a bare commit hash and that would fail the whole fetch.
         remote, _ = self.GetRemoteBranch()
         if not scm.GIT.IsValidRevision(settings.GetRoot(), external_base):
             RunGitSilent(['fetch', remote, external_base])
 
-        # Get the diff between local_ps and external_ps.
+        # Get the diff between local_ps and external_ps. Both patchsets are
+        # fetched at once; their commit hashes are known from the change detail.
         print('Fetching changes...')
         issue = self.GetIssue()
         changes_ref = 'refs/changes/%02d/%d/' % (issue % 100, issue)
-        RunGitSilent(['fetch', remote, changes_ref + str(local_ps)])
-        last_uploaded = RunGitSilent(['rev-parse', 'FETCH_HEAD']).strip()
-        RunGitSilent(['fetch', remote, changes_ref + str(external_ps)])
-        latest_external = RunGitSilent(['rev-parse', 'FETCH_HEAD']).strip()
+        RunGitSilent([
+            'fetch', remote, changes_ref + str(local_ps),
+            changes_ref + str(external_ps)
+        ])
+        last_uploaded = ps_to_pair[local_ps][0]
+        latest_external = ps_to_pair[external_ps][0]
 
         # If the commit parents are different, don't apply the diff as it very
         # likely contains many more changes not relevant to this CL.
@@ -3478,29 +3868,27 @@ class Changelist(object):
         if not diff:
             return external_base
 
-        # Apply the diff.
-        with gclient_utils.temporary_file() as diff_tempfile:
-            gclient_utils.FileWrite(diff_tempfile, diff)
-            clean_patch = RunGitWithCode(['apply', '--check',
-                                          diff_tempfile])[0] == 0
-            RunGitSilent(['apply', '-3', '--intent-to-add', diff_tempfile])
-            if not clean_patch:
-                # Normally patchset is set after upload. But because we exit,
-                # that never happens. Updating here makes sure that subsequent
-                # uploads don't need to fetch/apply the same diff again.
-                self.SetPatchset(external_ps)
-                DieWithError(
-                    '\nPatch did not apply cleanly. Please resolve any '
-                    'conflicts and reupload.')
-
-            message = 'Incorporate external changes from '
-            if num_changes == 1:
-                message += 'patchset %d' % external_ps
-            else:
-                message += 'patchsets %d to %d' % (local_ps + 1, external_ps)
-            RunGitSilent(['commit', '-am', message])
-            # TODO(crbug.com/1382528): Use the previous commit's message as a
-            # default patchset title instead of this 'Incorporate' message.
+        # Apply the diff, which git apply reads from stdin. git apply -3 exits
+        # with non-zero if conflicts are left behind.
+        clean_patch = RunGitWithCode(['apply', '-3', '--intent-to-add'],
+                                     suppress_stderr=True,
+                                     stdin=diff.encode('utf-8'))[0] == 0
+        if not clean_patch:
+            # Normally patchset is set after upload. But because we exit, that
+            # never happens. Updating here makes sure that subsequent uploads
+            # don't need to fetch/apply the same diff again.
+            self.SetPatchset(external_ps)
+            DieWithError('\nPatch did not apply cleanly. Please resolve any '
+                         'conflicts and reupload.')
+
+        message = 'Incorporate external changes from '
+        if num_changes == 1:
+            message += 'patchset %d' % external_ps
+        else:
+            message += 'patchsets %d to %d' % (local_ps + 1, external_ps)
+        RunGitSilent(['commit', '-am', message])
+        # TODO(crbug.com/1382528): Use the previous commit's message as a
+        # default patchset title instead of this 'Incorporate' message.
         return external_base
 
     def _AddChangeIdToCommitMessage(self, log_desc, args):
@@ -3529,7 +3917,7 @@ class Changelist(object):
         host = urllib.parse.urlparse(self.GetCodereviewServer()).hostname
         issue = self.GetIssue()
         patchset = int(patchset or self.GetPatchset())
-        data = self._GetChangeDetail(['ALL_REVISIONS'])
+        data = self._GetChangeDetail(_ALL_REVISIONS_OPTS)
 
         assert host and issue and patchset, 'CL must be uploaded first'
 
@@ -3548,10 +3936,10 @@ class Changelist(object):
         }
 
     def GetIssueOwner(self):
-        return self._GetChangeDetail(['DETAILED_ACCOUNTS'])['owner']['email']
+        return self._GetChangeDetail(_DETAILED_ACCOUNTS_OPTS)['owner']['email']
 
     def GetReviewers(self):
-        details = self._GetChangeDetail(['DETAILED_ACCOUNTS'])
+        details = self._GetChangeDetail(_DETAILED_ACCOUNTS_OPTS)
         return [r['email'] for r in details['reviewers'].get('REVIEWER', [])]
 
 
@@ -3573,11 +3961,10 @@ def _get_bug_line_values(default_project_prefix, bugs):
     others = []
     for bug in bugs.split(','):
         bug = bug.strip()
-        if bug:
-            try:
-                default_bugs.append(int(bug))
-            except ValueError:
-                others.append(bug)
+        if bug.isdecimal():
+            default_bugs.append(int(bug))
+        elif bug:
+            others.append(bug)
 
     if default_bugs:
         default_bugs = ','.join(map(str, default_bugs))
@@ -3605,8 +3992,10 @@ def FindCodereviewSettingsFile(filename='codereview.settings'):
     if os.path.isfile(os.path.join(root, inherit_ok_file)):
         root = None
     while True:
-        if os.path.isfile(os.path.join(cwd, filename)):
+        try:
             return open(os.path.join(cwd, filename))
+        except (FileNotFoundError, IsADirectoryError):
+            pass
         if cwd == root:
             break
         parent_dir = os.path.dirname(cwd)
@@ -3666,14 +4055,15 @@ def urlretrieve(source, destination):
 
     This is necessary because urllib is broken for SSL connections via a proxy.
     """
-    with open(destination, 'wb') as f:
-        f.write(urllib.request.urlopen(source).read())
+    with urllib.request.urlopen(source) as response, \
+            open(destination, 'wb') as f:
+        shutil.copyfileobj(response, f, 128 * 1024)
 
 
 def hasSheBang(fname):
     """Checks fname is a #! script."""
-    with open(fname) as f:
-        return f.read(2).startswith('#!')
+    with open(fname, 'rb') as f:
+        return f.read(2) == b'#!'
 
 
 def DownloadGerritHook(force):
@@ -3688,21 +4078,29 @@ def DownloadGerritHook(force):
         if os.path.exists(dst):
             if not force:
                 return
+        # Download next to the hook and move it into place only once it is
+        # complete, so a failed download never leaves a broken hook behind.
+        tmp = None
         try:
-            urlretrieve(src, dst)
-            if not hasSheBang(dst):
+            fd, tmp = tempfile.mkstemp(prefix='commit-msg.',
+                                       dir=os.path.dirname(dst))
+            os.close(fd)
+            urlretrieve(src, tmp)
+            if not hasSheBang(tmp):
                 DieWithError('Not a script: %s\n'
                              'You need to download from\n%s\n'
                              'into .git/hooks/commit-msg and '
                              'chmod +x .git/hooks/commit-msg' % (dst, src))
-            os.chmod(dst, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+            os.replace(tmp, dst)
         except Exception:
-            if os.path.exists(dst):
-                os.remove(dst)
             DieWithError('\nFailed to download hooks.\n'
                          'You need to download from\n%s\n'
                          'into .git/hooks/commit-msg and '
                          'chmod +x .git/hooks/commit-msg' % src)
+        finally:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
 
 
 class _GitCookiesChecker(object):
@@ -3711,6 +4109,8 @@ class _GitCookiesChecker(object):
         # Cached list of [host, identity, source], where source is
         # .gitcookies
         self._all_hosts = None
+        # Cached map from canonic host to pair of identities (Git, Gerrit).
+        self._identity_pairs = None
 
     def ensure_configured_gitcookies(self):
         """Runs checks and suggests fixes to make git use .gitcookies from default
@@ -3755,6 +4155,8 @@ class _GitCookiesChecker(object):
 
         confirm_or_exit('Move existing .gitcookies to default location?',
                         action='move')
+        # shutil.move renames when both paths are on the same filesystem and
+        # only copies across filesystems.
         shutil.move(configured_path, default_path)
         scm.GIT.SetConfig(settings.GetRoot(),
                           'http.cookiefile',
@@ -3793,11 +4195,13 @@ class _GitCookiesChecker(object):
         if not hosts:
             print('No Git/Gerrit credentials found.')
             return
-        lengths = [max(map(len, (row[i] for row in hosts))) for i in range(3)]
-        header = [('Host', 'User', 'Which file'), ['=' * l for l in lengths]]
-        print('Your .gitcookies have credentials for these hosts:')
-        for row in (header + hosts):
-            print('\t'.join((('%%+%ds' % l) % s) for l, s in zip(lengths, row)))
+        lengths = [max(map(len, column)) for column in zip(*hosts)]
+        header = [('Host', 'User', 'Which file'),
+                  tuple('=' * l for l in lengths)]
+        tmpl = '\t'.join('%%%ds' % l for l in lengths)
+        lines = ['Your .gitcookies have credentials for these hosts:']
+        lines.extend(tmpl % row for row in header + hosts)
+        print('\n'.join(lines))
 
     @staticmethod
     def _parse_identity(identity):
@@ -3806,12 +4210,10 @@ class _GitCookiesChecker(object):
         # distinguishable from sub-domains. But we do know typical domains:
         if identity.endswith('.chromium.org'):
             domain = 'chromium.org'
-            username = identity[:-len('.chromium.org')]
+            username = identity.removesuffix('.chromium.org')
         else:
-            username, domain = identity.split('.', 1)
-        if username.startswith('git-'):
-            username = username[len('git-'):]
-        return username, domain
+            username, _, domain = identity.partition('.')
+        return username.removeprefix('git-'), domain
 
     def has_generic_host(self):
         """Returns whether generic .googlesource.com has been configured.
@@ -3828,13 +4230,17 @@ class _GitCookiesChecker(object):
 
         One of identities might be None, meaning not configured.
         """
-        host_to_identity_pairs = {}
-        for host, identity, _ in self.get_hosts_with_creds():
-            canonical = _canonical_git_googlesource_host(host)
-            pair = host_to_identity_pairs.setdefault(canonical, [None, None])
-            idx = 0 if canonical == host else 1
-            pair[idx] = identity
-        return host_to_identity_pairs
+        if self._identity_pairs is None:
+            host_to_identity_pairs = {}
+            for host, identity, _ in self.get_hosts_with_creds():
+                canonical = _canonical_git_googlesource_host(host)
+                pair = host_to_identity_pairs.get(canonical)
+                if pair is None:
+                    pair = host_to_identity_pairs[canonical] = [None, None]
+                idx = 0 if canonical == host else 1
+                pair[idx] = identity
+            self._identity_pairs = host_to_identity_pairs
+        return self._identity_pairs
 
     def get_partially_configured_hosts(self):
         return set(
@@ -3849,9 +4255,14 @@ class _GitCookiesChecker(object):
             if None not in (i1, i2) and i1 != i2)
 
     def get_duplicated_hosts(self):
-        counters = collections.Counter(
-            h for h, _, _ in self.get_hosts_with_creds())
-        return set(host for host, count in counters.items() if count > 1)
+        seen = set()
+        duplicated = set()
+        for host, _, _ in self.get_hosts_with_creds():
+            if host in seen:
+                duplicated.add(host)
+            else:
+                seen.add(host)
+        return duplicated
 
     @staticmethod
     def _format_hosts(hosts, extra_column_func=None):
@@ -3890,42 +4301,47 @@ class _GitCookiesChecker(object):
 
         conflicting = self.get_conflicting_hosts()
         if conflicting:
+            pairs = self._get_git_gerrit_identity_pairs()
             yield (
                 'The following Git hosts have differing credentials from their '
                 'Gerrit counterparts',
                 self._format_hosts(
-                    conflicting, lambda host: '%s vs %s' % tuple(
-                        self._get_git_gerrit_identity_pairs()[host])),
-                conflicting)
+                    conflicting,
+                    lambda host: '%s vs %s' % tuple(pairs[host])), conflicting)
 
     def find_and_report_problems(self):
         """Returns True if there was at least one problem, else False."""
-        found = False
+        # The report is collected and printed at once.
+        lines = []
         bad_hosts = set()
         for title, sublines, hosts in self._find_problems():
-            if not found:
-                found = True
-                print('\n\n.gitcookies problem report:\n')
+            if not lines:
+                lines.extend(['', '', '.gitcookies problem report:', ''])
             bad_hosts.update(hosts or [])
-            print('  %s%s' % (title, (':' if sublines else '')))
+            lines.append('  %s%s' % (title, (':' if sublines else '')))
             if sublines:
-                print()
-                print('    %s' % '\n    '.join(sublines))
-            print()
+                lines.append('')
+                lines.extend('    %s' % l for l in sublines)
+            lines.append('')
 
         if bad_hosts:
-            assert found
-            print(
+            assert lines
+            lines.append(
                 '  You can manually remove corresponding lines in your %s file and '
                 'visit the following URLs with correct account to generate '
                 'correct credential lines:\n' %
                 gerrit_util.CookiesAuthenticator.get_gitcookies_path())
-            print('    %s' % '\n    '.join(
-                sorted(
-                    set(gerrit_util.CookiesAuthenticator().get_new_password_url(
-                        _canonical_git_googlesource_host(host))
-                        for host in bad_hosts))))
-        return found
+            authenticator = gerrit_util.CookiesAuthenticator()
+            urls = {
+                authenticator.get_new_password_url(
+                    _canonical_git_googlesource_host(host))
+                for host in bad_hosts
+            }
+            lines.extend('    %s' % url for url in sorted(urls))
+
+        if lines:
+            print('\n'.join(lines))
+        return bool(lines)
 
 
 @metrics.collector.collect_metrics('git cl creds-check')
@@ -3990,33 +4406,37 @@ def CMDbaseurl(parser, args):
         return 1
 
     _, args = parser.parse_args(args)
-    branchref = scm.GIT.GetBranchRef(settings.GetRoot())
+    root = settings.GetRoot()
+    branchref = scm.GIT.GetBranchRef(root)
     branch = scm.GIT.ShortBranchName(branchref)
     if not args:
         print('Current base-url:')
-        url = scm.GIT.GetConfig(settings.GetRoot(), f'branch.{branch}.base-url')
+        url = scm.GIT.GetConfig(root, f'branch.{branch}.base-url')
         if url is None:
             raise ValueError('Missing base URL.')
         return url
 
     print('Setting base-url to %s' % args[0])
-    scm.GIT.SetConfig(settings.GetRoot(), f'branch.{branch}.base-url', args[0])
+    scm.GIT.SetConfig(root, f'branch.{branch}.base-url', args[0])
     return 0
 
 
+_BOLD = '\033[1m'
+_STATUS_COLORS = {
+    'unsent': _BOLD + Fore.YELLOW,
+    'waiting': _BOLD + Fore.RED,
+    'reply': _BOLD + Fore.YELLOW,
+    'not lgtm': _BOLD + Fore.RED,
+    'lgtm': _BOLD + Fore.GREEN,
+    'commit': _BOLD + Fore.MAGENTA,
+    'closed': _BOLD + Fore.CYAN,
+    'error': _BOLD + Fore.WHITE,
+}
+
+
 def color_for_status(status):
     """Maps a Changelist status to color, for CMDstatus and other tools."""
-    BOLD = '\033[1m'
-    return {
-        'unsent': BOLD + Fore.YELLOW,
-        'waiting': BOLD + Fore.RED,
-        'reply': BOLD + Fore.YELLOW,
-        'not lgtm': BOLD + Fore.RED,
-        'lgtm': BOLD + Fore.GREEN,
-        'commit': BOLD + Fore.MAGENTA,
-        'closed': BOLD + Fore.CYAN,
-        'error': BOLD + Fore.WHITE,
-    }.get(status, Fore.WHITE)
+    return _STATUS_COLORS.get(status, Fore.WHITE)
 
 
 def get_cl_statuses(changes: List[Changelist],
@@ -4044,19 +4464,25 @@ def get_cl_statuses(changes: List[Changelist],
             yield (cl, 'waiting' if cl.GetIssueURL() else 'error')
         return
 
-    # First, sort out authentication issues.
+    # First, sort out authentication issues. Branches of the same repository
+    # share their credentials, so each remote and server is checked once.
     logging.debug('ensuring credentials exist')
+    checked = set()
     for cl in changes:
-        cl.EnsureAuthenticated(force=False)
+        remote_url = cl.GetRemoteUrl()
+        key = (remote_url, remote_url and cl.GetCodereviewServer())
+        if key not in checked:
+            checked.add(key)
+            cl.EnsureAuthenticated(force=False)
 
     def fetch(cl):
         try:
             return (cl, cl.GetStatus())
-        except:
+        except Exception:
             # See http://crbug.com/629863.
             logging.exception('failed to fetch status for cl %s:',
                               cl.GetIssue())
-            raise
+            return (cl, 'error')
 
     threads_count = min(gerrit_util.MAX_CONCURRENT_CONNECTION, len(changes))
     if max_processes:
@@ -4064,11 +4490,15 @@ def get_cl_statuses(changes: List[Changelist],
     logging.debug('querying %d CLs using %d threads', len(changes),
                   threads_count)
 
+    # ThreadPool's workers are daemon threads, so a request that never returns
+    # doesn't keep the process alive once the remaining CLs are given up on.
     pool = multiprocessing.pool.ThreadPool(threads_count)
     fetched_cls = set()
     try:
         it = pool.imap_unordered(fetch, changes).__iter__()
         while True:
+            # Yield statuses as soon as they arrive, but give up on the
+            # remaining CLs if none of them finishes within 5 seconds.
             try:
                 cl, status = it.next(timeout=5)
             except (multiprocessing.TimeoutError, StopIteration):
@@ -4079,8 +4509,9 @@ def get_cl_statuses(changes: List[Changelist],
         pool.close()
 
     # Add any branches that failed to fetch.
-    for cl in set(changes) - fetched_cls:
-        yield (cl, 'error')
+    for cl in changes:
+        if cl not in fetched_cls:
+            yield (cl, 'error')
 
 
 def upload_branch_deps(cl, args, force=False):
@@ -4136,15 +4567,24 @@ def upload_branch_deps(cl, args, force=False):
     print('The dependent local branches of %s are:' % root_branch)
     dependents = []
 
-    def traverse_dependents_preorder(branch, padding=''):
-        dependents_to_process = tracked_to_dependents.get(branch, [])
-        padding += '  '
-        for dependent in dependents_to_process:
-            print('%s%s' % (padding, dependent))
-            dependents.append(dependent)
-            traverse_dependents_preorder(dependent, padding)
-
-    traverse_dependents_preorder(root_branch)
+    # Traverse the dependents in preorder with an explicit stack. Dependents
+    # are pushed in reverse so that they are popped in their original order.
+    # Branches seen before are skipped in case upstreams form a cycle.
+    stack = []
+    visited = {root_branch}
+
+    def push_dependents(branch, padding):
+        for dependent in reversed(tracked_to_dependents.get(branch, [])):
+            if dependent not in visited:
+                visited.add(dependent)
+                stack.append((dependent, padding))
+
+    push_dependents(root_branch, '  ')
+    while stack:
+        branch, padding = stack.pop()
+        print('%s%s' % (padding, branch))
+        dependents.append(branch)
+        push_dependents(branch, padding + '  ')
     print()
 
     if not dependents:
@@ -4184,20 +4624,46 @@ def upload_branch_deps(cl, args, force=False):
     return 0
 
 
-def GetArchiveTagForBranch(issue_num, branch_name, existing_tags, pattern):
+def GetArchiveTagForBranch(issue_num,
+                           branch_name,
+                           existing_tags,
+                           pattern,
+                           next_suffixes=None):
     """Given a proposed tag name, returns a tag name that is guaranteed to be
     unique. If 'foo' is proposed but already exists, then 'foo-2' is used,
-    or 'foo-3', and so on."""
+    or 'foo-3', and so on.
 
-    proposed_tag = pattern.format(**{'issue': issue_num, 'branch': branch_name})
-    for suffix_num in itertools.count(1):
-        if suffix_num == 1:
-            to_check = proposed_tag
-        else:
-            to_check = '%s-%d' % (proposed_tag, suffix_num)
+    The returned name is added to the existing_tags set, so that later calls
+    don't propose it again. If next_suffixes is a dict, it remembers the first
+    suffix worth trying for each proposed tag across calls."""
 
-        if to_check not in existing_tags:
-            return to_check
+    if '{' in pattern:
+        proposed_tag = pattern.format(issue=issue_num, branch=branch_name)
+    else:
+        proposed_tag = pattern
+    suffix_num = 1
+    if next_suffixes is not None:
+        suffix_num = next_suffixes.get(proposed_tag, 1)
+    to_check = proposed_tag
+    if suffix_num > 1:
+        to_check = '%s-%d' % (proposed_tag, suffix_num)
+    while to_check in existing_tags:
+        suffix_num += 1
+        to_check = '%s-%d' % (proposed_tag, suffix_num)
+    existing_tags.add(to_check)
+    if next_suffixes is not None:
+        next_suffixes[proposed_tag] = suffix_num + 1
+    return to_check
+
+
+def _list_heads_and_tags() -> Tuple[List[str], List[str]]:
+    """Returns the full names of local branches and of tags, using a single
+    git call."""
+    heads, tags = [], []
+    for ref in RunGit(['for-each-ref', '--format=%(refname)', 'refs/heads',
+                       'refs/tags']).splitlines():
+        (heads if ref.startswith('refs/heads/') else tags).append(ref)
+    return heads, tags
 
 
 @metrics.collector.collect_metrics('git cl archive')
@@ -4237,26 +4703,29 @@ def CMDarchive(parser, args):
     if args:
         parser.error('Unsupported args: %s' % ' '.join(args))
 
-    branches = RunGit(['for-each-ref', '--format=%(refname)', 'refs/heads'])
+    branches, tags = _list_heads_and_tags()
     if not branches:
         return 0
 
-    tags = RunGit(['for-each-ref', '--format=%(refname)', 'refs/tags'
-                   ]).splitlines() or []
-    tags = [t.split('/')[-1] for t in tags]
+    tags = {t.split('/')[-1] for t in tags}
 
     print('Finding all branches associated with closed issues...')
-    changes = [Changelist(branchref=b) for b in branches.splitlines()]
+    changes = [Changelist(branchref=b) for b in branches]
     alignment = max(5, max(len(c.GetBranch()) for c in changes))
+    # Branches without an issue can't be closed; don't query them.
+    changes = [c for c in changes if c.GetIssue()]
     statuses = get_cl_statuses(changes,
                                fine_grained=True,
                                max_processes=options.maxjobs)
-    proposal = [(cl.GetBranch(),
-                 GetArchiveTagForBranch(cl.GetIssue(), cl.GetBranch(), tags,
-                                        options.pattern))
-                for cl, status in statuses
-                if status in ('closed', 'rietveld-not-supported')]
-    proposal.sort()
+    # Statuses arrive in completion order; sort before picking tag names so
+    # that colliding names get the same suffixes on every run.
+    closed = sorted((cl.GetBranch(), cl.GetIssue()) for cl, status in statuses
+                    if status in ('closed', 'rietveld-not-supported'))
+    next_suffixes = {}
+    proposal = [(branch,
+                 GetArchiveTagForBranch(issue, branch, tags, options.pattern,
+                                        next_suffixes))
+                for branch, issue in closed]
 
     if not proposal:
         print('No branches with closed codereview issues found.')
@@ -4341,7 +4810,11 @@ def CMDsquash_closed(parser, args):
         return 0
 
     print('Finding all branches associated with closed issues...')
-    changes = [Changelist(branchref=b) for b in branches.splitlines()]
+    # Branches without an issue can't be closed; don't query them.
+    changes = [
+        c for c in (Changelist(branchref=b) for b in branches.splitlines())
+        if c.GetIssue()
+    ]
     statuses = get_cl_statuses(changes,
                                fine_grained=True,
                                max_processes=options.maxjobs)
@@ -4466,6 +4939,9 @@ def CMDstatus(parser, args):
                 print(url)
         return 0
 
+    # A single for-each-ref supplies every branch along with its commit date.
+    # The per-branch issue and server lookups below are served from the cached
+    # git config, so no further git processes are spawned per branch.
     branches = RunGit([
         'for-each-ref', '--format=%(refname) %(committerdate:unix)',
         'refs/heads'
@@ -4476,7 +4952,7 @@ def CMDstatus(parser, args):
 
     changes = [
         Changelist(branchref=b, commit_date=ct)
-        for b, ct in map(lambda line: line.split(' '), branches.splitlines())
+        for b, _, ct in (line.rpartition(' ') for line in branches.splitlines())
     ]
     print('Branches associated with reviews:')
     output = get_cl_statuses(changes,
@@ -4502,8 +4978,12 @@ def CMDstatus(parser, args):
 
     branch_statuses = {}
 
-    alignment = max(5,
-                    max(len(FormatBranchName(c.GetBranch())) for c in changes))
+    # Format each branch name once; the widths give the column alignment.
+    branch_displays = {
+        c.GetBranch(): FormatBranchName(c.GetBranch())
+        for c in changes
+    }
+    alignment = max(5, max(map(len, branch_displays.values())))
 
     if options.date_order or settings.IsStatusCommitOrderByDate():
         sorted_changes = sorted(changes,
@@ -4511,6 +4991,10 @@ def CMDstatus(parser, args):
                                 reverse=True)
     else:
         sorted_changes = sorted(changes, key=lambda c: c.GetBranch())
+
+    is_tty = setup_color.IS_TTY
+    # Turn off bold as well as colors.
+    reset = Fore.RESET + '\033[0m' if is_tty else ''
     for cl in sorted_changes:
         branch = cl.GetBranch()
         while branch not in branch_statuses:
@@ -4522,16 +5006,10 @@ def CMDstatus(parser, args):
             # The issue probably doesn't exist anymore.
             url += ' (broken)'
 
-        color = color_for_status(status)
-        # Turn off bold as well as colors.
-        END = '\033[0m'
-        reset = Fore.RESET + END
-        if not setup_color.IS_TTY:
-            color = ''
-            reset = ''
+        color = color_for_status(status) if is_tty else ''
         status_str = '(%s)' % status if status else ''
 
-        branch_display = FormatBranchName(branch)
+        branch_display = branch_displays[branch]
         padding = ' ' * (alignment - len(branch_display))
         if not options.no_branch_color:
             branch_display = FormatBranchName(branch, colorize=True)
@@ -4554,21 +5032,24 @@ def CMDstatus(parser, args):
     return 0
 
 
+# Matches the "- <Color>  <meaning>" legend lines of the CMDstatus docstring.
+_STATUS_DOC_LEGEND_RE = re.compile(r'^( *-)( *(\w+).*)$', re.MULTILINE)
+
+
 def colorize_CMDstatus_doc():
     """To be called once in main() to add colors to git cl status help."""
-    colors = [i for i in dir(Fore) if i[0].isupper()]
+    if getattr(CMDstatus, 'doc_colorized', False):
+        return
 
-    def colorize_line(line):
-        for color in colors:
-            if color in line.upper():
-                # Extract whitespace first and the leading '-'.
-                indent = len(line) - len(line.lstrip(' ')) + 1
-                return line[:indent] + getattr(
-                    Fore, color) + line[indent:] + Fore.RESET
-        return line
+    def colorize_line(match):
+        color = getattr(Fore, match.group(3).upper(), None)
+        if color is None:
+            return match.group(0)
+        return match.group(1) + color + match.group(2) + Fore.RESET
 
-    lines = CMDstatus.__doc__.splitlines()
-    CMDstatus.__doc__ = '\n'.join(colorize_line(l) for l in lines)
+    CMDstatus.__doc__ = _STATUS_DOC_LEGEND_RE.sub(colorize_line,
+                                                  CMDstatus.__doc__)
+    CMDstatus.doc_colorized = True
 
 
 def write_json(path, contents):
@@ -4579,6 +5060,24 @@ def write_json(path, contents):
             json.dump(contents, f)
 
 
+def write_json_iter(path, items):
+    """Like write_json, but writes `items` as a JSON list one item at a time,
+    without materializing the whole list first."""
+    def write(f):
+        f.write('[')
+        for i, item in enumerate(items):
+            if i:
+                f.write(', ')
+            json.dump(item, f)
+        f.write(']')
+
+    if path == '-':
+        write(sys.stdout)
+    else:
+        with open(path, 'w') as f:
+            write(f)
+
+
 @subcommand.usage('[issue_number]')
 @metrics.collector.collect_metrics('git cl issue')
 def CMDissue(parser, args):
@@ -4608,18 +5107,20 @@ def CMDissue(parser, args):
     if options.reverse:
         branches = RunGit(['for-each-ref', 'refs/heads',
                            '--format=%(refname)']).splitlines()
-        # Reverse issue lookup.
+        # Reverse issue lookup. Every branch with an issue has a
+        # branch.<name>.gerritissue key, so a single pass over the cached
+        # config is enough; don't query each branch individually. Keys left
+        # behind by deleted branches are ignored.
+        issue_key_re = re.compile(r'^branch\.(.+)\.' +
+                                  re.escape(ISSUE_CONFIG_KEY) + r'$')
+        branch_issues = {}
+        for name, issue in scm.GIT.YieldConfigRegexp(settings.GetRoot(),
+                                                     issue_key_re):
+            if issue:
+                branch_issues[issue_key_re.match(name).group(1)] = issue
         issue_branch_map = {}
-
-        git_config = {}
-        for name, val in scm.GIT.YieldConfigRegexp(
-                settings.GetRoot(), re.compile(r'branch\..*issue')):
-            git_config[name] = val
-
         for branch in branches:
-            issue = git_config.get(
-                'branch.%s.%s' %
-                (scm.GIT.ShortBranchName(branch), ISSUE_CONFIG_KEY))
+            issue = branch_issues.get(scm.GIT.ShortBranchName(branch))
             if issue:
                 issue_branch_map.setdefault(int(issue), []).append(branch)
         if not args:
@@ -4650,14 +5151,15 @@ def CMDissue(parser, args):
         cl.SetIssue(issue.issue)
     else:
         cl = Changelist()
-    print('Issue number: %s (%s)' % (cl.GetIssue(), cl.GetIssueURL()))
+    issue_number, issue_url = cl.GetIssue(), cl.GetIssueURL()
+    print('Issue number: %s (%s)' % (issue_number, issue_url))
     if options.json:
         write_json(
             options.json, {
                 'gerrit_host': cl.GetGerritHost(),
                 'gerrit_project': cl.GetGerritProject(),
-                'issue_url': cl.GetIssueURL(),
-                'issue': cl.GetIssue(),
+                'issue_url': issue_url,
+                'issue': issue_number,
             })
     return 0
 
@@ -4666,16 +5168,16 @@ def _create_commit_message(orig_message, bug=None):
     """Returns a commit message for the cherry picked CL."""
     orig_message_lines = orig_message.splitlines()
     subj_line = orig_message_lines[0]
-    new_message = (f'Cherry pick "{subj_line}"\n\n'
-                   "Original change's description:\n")
-    for line in orig_message_lines:
-        new_message += f'> {line}\n'
-    new_message += '\n'
+    parts = [
+        f'Cherry pick "{subj_line}"\n\n', "Original change's description:\n"
+    ]
+    parts.extend(f'> {line}\n' for line in orig_message_lines)
+    parts.append('\n')
     if bug:
-        new_message += f'Bug: {bug}\n'
+        parts.append(f'Bug: {bug}\n')
     if change_id := git_footers.get_footer_change_id(orig_message):
-        new_message += f'Change-Id: {change_id[0]}\n'
-    return new_message
+        parts.append(f'Change-Id: {change_id[0]}\n')
+    return ''.join(parts)
 
 
 # TODO(b/341792235): Add metrics.
@@ -4727,16 +5229,40 @@ def CMDcherry_pick(parser, args):
     change_ids_to_commit = {}
 
     # Gerrit needs a change ID for each commit we cherry pick.
+    # Don't use the ChangeId in the commit message since it may not be
+    # unique. Gerrit will error with "Multiple changes found" if we use a
+    # non-unique ID. Instead, query Gerrit with the hashes and verify each
+    # corresponds to a unique CL. The hashes are OR'ed together in batches
+    # to keep the query URLs short, and the batches are issued concurrently,
+    # along with the lookup of the initial parent's revision.
+    def query_changes(commits):
+        return gerrit_util.MultiQueryChanges(
+            host, [], ['commit:%s' % commit for commit in commits],
+            o_params=['CURRENT_REVISION', 'CURRENT_COMMIT'])
+
+    commits = list(dict.fromkeys(args))
+    batches = [
+        commits[i:i + _MAX_CHERRY_PICK_QUERY_COMMITS]
+        for i in range(0, len(commits), _MAX_CHERRY_PICK_QUERY_COMMITS)
+    ]
+    changes_by_commit = collections.defaultdict(list)
+    parent_commit_hash = None
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        parent_details = None
+        if options.parent_change_num:
+            parent_details = executor.submit(gerrit_util.GetChangeDetail,
+                                             host,
+                                             str(options.parent_change_num),
+                                             o_params=['CURRENT_REVISION'])
+        for changes in executor.map(query_changes, batches):
+            for change in changes:
+                for revision in change['revisions']:
+                    changes_by_commit[revision].append(change)
+        if parent_details:
+            parent_commit_hash = parent_details.result()['current_revision']
+
     for commit in args:
-        # Don't use the ChangeId in the commit message since it may not be
-        # unique. Gerrit will error with "Multiple changes found" if we use a
-        # non-unique ID. Instead, query Gerrit with the hash and verify it
-        # corresponds to a unique CL.
-        changes = gerrit_util.QueryChanges(
-            host=host,
-            params=[('commit', commit)],
-            o_params=['CURRENT_REVISION', 'CURRENT_COMMIT'],
-        )
+        changes = changes_by_commit.get(commit)
         if not changes:
             raise RuntimeError(f'No changes found for {commit}.')
         if len(changes) > 1:
@@ -4760,20 +5286,21 @@ def CMDcherry_pick(parser, args):
     # Gerrit only supports cherry picking one commit per change, so we have
     # to cherry pick each commit individually and create a chain of CLs.
     parent_change_num = options.parent_change_num
-    parent_commit_hash = None
 
     for change_id, orig_message in change_ids_to_message.items():
         message = _create_commit_message(orig_message, options.bug)
-        orig_subj_line = orig_message.splitlines()[0]
+        orig_subj_line = orig_message.partition('\n')[0]
         original_commit_hash = change_ids_to_commit[change_id]
 
-        # Determine the base commit hash for the current cherry-pick by fetching
-        # the details of the previous CL (identified by parent_change_num).
-        # Skip if this is the first CL and no initial parent was given.
+        # Determine the base commit hash for the current cherry-pick from the
+        # previous CL (identified by parent_change_num). The initial parent's
+        # was fetched above. Skip if this is the first CL and no initial
+        # parent was given.
         if parent_change_num:
-            parent_details = gerrit_util.GetChangeDetail(
-                host, str(parent_change_num), o_params=['CURRENT_REVISION'])
-            parent_commit_hash = parent_details['current_revision']
+            if not parent_commit_hash:
+                parent_details = gerrit_util.GetChangeDetail(
+                    host, str(parent_change_num), o_params=['CURRENT_REVISION'])
+                parent_commit_hash = parent_details['current_revision']
             print(f'Using base commit {parent_commit_hash} '
                   f'from parent CL {parent_change_num}.')
 
@@ -4798,6 +5325,9 @@ def CMDcherry_pick(parser, args):
         new_change_url = gerrit_util.GetChangePageUrl(host, new_change_num)
         print(f'Created cherry pick of "{orig_subj_line}": {new_change_url}')
         parent_change_num = new_change_num
+        # The cherry-pick response doesn't include the revision of the new
+        # CL, so it is fetched before the next cherry-pick.
+        parent_commit_hash = None
 
     return 0
 
@@ -4852,12 +5382,13 @@ def CMDcomments(parser, args):
 
     summary = sorted(cl.GetCommentsSummary(readable=options.readable),
                      key=lambda c: c.date)
+    owner = cl.GetIssueOwner() if summary else None
     for comment in summary:
         if comment.disapproval:
             color = Fore.RED
         elif comment.approval:
             color = Fore.GREEN
-        elif comment.sender == cl.GetIssueOwner():
+        elif comment.sender == owner:
             color = Fore.MAGENTA
         elif comment.autogenerated:
             color = Fore.CYAN
@@ -4875,7 +5406,7 @@ def CMDcomments(parser, args):
             dct['date'] = dct['date'].strftime('%Y-%m-%d %H:%M:%S.%f')
             return dct
 
-        write_json(options.json_file, [pre_serialize(x) for x in summary])
+        write_json_iter(options.json_file, (pre_serialize(x) for x in summary))
     return 0
 
 
@@ -4927,7 +5458,8 @@ def CMDdescription(parser, args):
     if args and not args[0].isdigit():
         logging.info('canonical issue/change URL: %s\n', cl.GetIssueURL())
 
-    description = ChangeDescription(cl.FetchDescription())
+    original_description = cl.FetchDescription()
+    description = ChangeDescription(original_description)
 
     if options.display:
         print(description.description)
@@ -4944,7 +5476,7 @@ def CMDdescription(parser, args):
         description.set_description(text)
     else:
         description.prompt()
-    if cl.FetchDescription().strip() != description.description:
+    if original_description.strip() != description.description:
         cl.UpdateDescription(description.description, force=options.force)
     return 0
 
@@ -5005,11 +5537,20 @@ def CMDlint(parser, args):
         action='append',
         metavar='-x,+y',
         help='Comma-separated list of cpplint\'s category-filters')
+    parser.add_option('-j',
+                      '--jobs',
+                      type=int,
+                      help='Maximum number of files to lint in parallel. '
+                      'Defaults to the number of CPUs.')
     options, args = parser.parse_args(args)
+    if options.jobs is not None and options.jobs < 1:
+        parser.error('--jobs must be >= 1')
     root_path, files = FindFilesForLint(options, args)
     if files is None:
         return 1
 
+    import presubmit_canned_checks
+
     # Access to a protected member _XX of a client class
     # pylint: disable=protected-access
     try:
@@ -5032,21 +5573,59 @@ def CMDlint(parser, args):
     previous_cwd = os.getcwd()
     try:
         os.chdir(root_path)
-        extra_check_functions = [
-            cpplint_chromium.CheckPointerDeclarationWhitespace
-        ]
-        for file in files_to_lint:
-            cpplint.ProcessFile(file, cpplint._cpplint_state.verbose_level,
-                                extra_check_functions)
+        if (len(files_to_lint) >= _LINT_PARALLEL_MIN_FILES
+                and options.jobs != 1):
+            # cpplint keeps its state in module globals, so each file is
+            # linted in a worker process and its output replayed in order.
+            error_count = 0
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=options.jobs,
+                    initializer=_InitLintWorker,
+                    initargs=(command, )) as executor:
+                for file_errors, output in executor.map(
+                        _LintFile, files_to_lint):
+                    sys.stderr.write(output)
+                    error_count += file_errors
+        else:
+            extra_check_functions = [
+                cpplint_chromium.CheckPointerDeclarationWhitespace
+            ]
+            for file in files_to_lint:
+                cpplint.ProcessFile(file, cpplint._cpplint_state.verbose_level,
+                                    extra_check_functions)
+            error_count = cpplint._cpplint_state.error_count
     finally:
         os.chdir(previous_cwd)
 
-    print('Total errors found: %d\n' % cpplint._cpplint_state.error_count)
-    if cpplint._cpplint_state.error_count != 0:
+    print('Total errors found: %d\n' % error_count)
+    if error_count != 0:
         return 1
     return 0
 
 
+def _InitLintWorker(cpplint_args):
+    """Applies CMDlint's cpplint arguments in a lint worker process."""
+    import cpplint
+    cpplint.ParseArguments(cpplint_args)
+
+
+def _LintFile(path):
+    """Lints `path` in a lint worker process.
+
+    Returns the number of errors found and the output cpplint produced.
+    """
+    # pylint: disable=protected-access
+    import cpplint
+    import cpplint_chromium
+    cpplint._cpplint_state.ResetErrorCounts()
+    output = io.StringIO()
+    with contextlib.redirect_stderr(output):
+        cpplint.ProcessFile(
+            path, cpplint._cpplint_state.verbose_level,
+            [cpplint_chromium.CheckPointerDeclarationWhitespace])
+    return cpplint._cpplint_state.error_count, output.getvalue()
+
+
 @metrics.collector.collect_metrics('git cl presubmit')
 @subcommand.usage('[base branch]')
 def CMDpresubmit(parser, args):
@@ -5095,16 +5674,25 @@ def CMDpresubmit(parser, args):
         return 1
 
     cl = Changelist()
-    if args:
-        base_branch = args[0]
-    else:
-        # Default to diffing against the common ancestor of the upstream branch.
-        base_branch = cl.GetCommonAncestorWithUpstream()
+    fetch_description = (not 'PRESUBMIT_SKIP_NETWORK' in os.environ
+                         and cl.GetIssue())
 
     start = time.time()
+    # Fetch the CL description from Gerrit while the base branch is being
+    # determined locally.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        if fetch_description:
+            description_future = executor.submit(cl.FetchDescription)
+        if args:
+            base_branch = args[0]
+        else:
+            # Default to diffing against the common ancestor of the upstream
+            # branch.
+            base_branch = cl.GetCommonAncestorWithUpstream()
+
     try:
-        if not 'PRESUBMIT_SKIP_NETWORK' in os.environ and cl.GetIssue():
-            description = cl.FetchDescription()
+        if fetch_description:
+            description = description_future.result()
         else:
             description = _create_description_from_log([base_branch])
     except Exception as e:
@@ -5166,6 +5754,32 @@ def GenerateGerritChangeId(message):
     return 'I%s' % change_hash.strip()
 
 
+def _BuildRefSpecSuffix(refspec_opts: List[str]) -> str:
+    """Returns the '%opt1,opt2' suffix for a refs/for/ push refspec.
+
+    Duplicate options are dropped, keeping the first occurrence.
+    """
+    if not refspec_opts:
+        return ''
+    refspec_opts = list(dict.fromkeys(refspec_opts))
+    assert not any(' ' in o for o in refspec_opts), (
+        'spaces not allowed in refspec options: %r' % refspec_opts)
+    return '%' + ','.join(refspec_opts)
+
+
+@functools.lru_cache(maxsize=32)
+def _TargetRefPrefixReplacements(remote):
+    """Returns the compiled (regex, replacement) pairs GetTargetRef uses to
+    canonicalize a target branch for `remote`."""
+    return (
+        (re.compile(r'^((refs/)?remotes/)?branch-heads/'),
+         'refs/remotes/branch-heads/'),
+        (re.compile(r'^((refs/)?remotes/)?%s/' % re.escape(remote)),
+         'refs/remotes/%s/' % remote),
+        (re.compile(r'^(refs/)?heads/'), 'refs/remotes/%s/' % remote),
+    )
+
+
 def GetTargetRef(remote, remote_branch, target_branch):
     """Computes the remote branch ref to use for the CL.
 
@@ -5177,23 +5791,17 @@ def GetTargetRef(remote, remote_branch, target_branch):
     if not (remote and remote_branch):
         return None
 
+    remote_prefix = 'refs/remotes/%s/' % remote
     if target_branch:
         # Canonicalize branch references to the equivalent local full symbolic
         # refs, which are then translated into the remote full symbolic refs
         # below.
         if '/' not in target_branch:
-            remote_branch = 'refs/remotes/%s/%s' % (remote, target_branch)
+            remote_branch = remote_prefix + target_branch
         else:
-            prefix_replacements = (
-                ('^((refs/)?remotes/)?branch-heads/',
-                 'refs/remotes/branch-heads/'),
-                ('^((refs/)?remotes/)?%s/' % remote,
-                 'refs/remotes/%s/' % remote),
-                ('^(refs/)?heads/', 'refs/remotes/%s/' % remote),
-            )
             match = None
-            for regex, replacement in prefix_replacements:
-                match = re.search(regex, target_branch)
+            for regex, replacement in _TargetRefPrefixReplacements(remote):
+                match = regex.search(target_branch)
                 if match:
                     remote_branch = target_branch.replace(
                         match.group(0), replacement)
@@ -5212,11 +5820,10 @@ def GetTargetRef(remote, remote_branch, target_branch):
     # * refs/remotes/origin/refs/diff/test -> refs/diff/test
     # * refs/remotes/origin/main -> refs/heads/main
     # * refs/remotes/branch-heads/test -> refs/branch-heads/test
-    if remote_branch.startswith('refs/remotes/%s/refs/' % remote):
-        remote_branch = remote_branch.replace('refs/remotes/%s/' % remote, '')
-    elif remote_branch.startswith('refs/remotes/%s/' % remote):
-        remote_branch = remote_branch.replace('refs/remotes/%s/' % remote,
-                                              'refs/heads/')
+    if remote_branch.startswith(remote_prefix + 'refs/'):
+        remote_branch = remote_branch.replace(remote_prefix, '')
+    elif remote_branch.startswith(remote_prefix):
+        remote_branch = remote_branch.replace(remote_prefix, 'refs/heads/')
     elif remote_branch.startswith('refs/remotes/branch-heads'):
         remote_branch = remote_branch.replace('refs/remotes/', 'refs/')
 
@@ -5229,8 +5836,7 @@ def cleanup_list(l):
     So that "--reviewers joe@c,john@c --reviewers joa@c" results in
     options.reviewers == sorted(['joe@c', 'john@c', 'joa@c']).
     """
-    items = sum((i.split(',') for i in l), [])
-    stripped_items = (i.strip() for i in items)
+    stripped_items = (item.strip() for i in l for item in i.split(','))
     return sorted(filter(None, stripped_items))
 
 
@@ -5442,7 +6048,7 @@ def CMDupload(parser, args):
     if options.git_completion_helper:
         print(' '.join(opt.get_opt_string() for opt in parser.option_list
                        if opt.help != optparse.SUPPRESS_HELP))
-        return
+        return 0
 
     cl = Changelist(branchref=options.target_branch)
 
@@ -5495,8 +6101,8 @@ def CMDupload(parser, args):
                          'allowed.')
         options.message = gclient_utils.FileRead(options.message_file)
 
-    if ([options.cq_dry_run, options.use_commit_queue, options.retry_failed
-         ].count(True) > 1):
+    if (bool(options.cq_dry_run) + bool(options.use_commit_queue) +
+            bool(options.retry_failed) > 1):
         parser.error('Only one of --use-commit-queue, --cq-dry-run or '
                      '--retry-failed is allowed.')
 
@@ -5642,11 +6248,7 @@ def UploadAllSquashed(options: optparse.Values,
         new_upload.change_desc,
         multi_change_upload=len(uploads_by_cl) > 1,
         dogfood_path=True)
-    refspec_suffix = ''
-    if refspec_opts:
-        refspec_suffix = '%' + ','.join(refspec_opts)
-        assert ' ' not in refspec_suffix, (
-            'spaces not allowed in refspec: "%s"' % refspec_suffix)
+    refspec_suffix = _BuildRefSpecSuffix(refspec_opts)
 
     remote, remote_branch = cl.GetRemoteBranch()
     branch = GetTargetRef(remote, remote_branch, options.target_branch)
@@ -5664,16 +6266,14 @@ def UploadAllSquashed(options: optparse.Values,
         'description':
         new_upload.change_desc.description,
     }
-    push_stdout = cl._RunGitPushWithTraces(refspec, refspec_opts,
-                                           git_push_metadata,
-                                           options.push_options)
+    change_numbers = []
+    cl._RunGitPushWithTraces(refspec,
+                             refspec_opts,
+                             git_push_metadata,
+                             options.push_options,
+                             change_numbers=change_numbers)
 
     # Post push updates
-    regex = re.compile(r'remote:\s+https?://[\w\-\.\+\/#]*/(\d+)\s.*')
-    change_numbers = [
-        m.group(1) for m in map(regex.match, push_stdout.splitlines()) if m
-    ]
-
     for i, (cl, new_upload) in enumerate(uploads_by_cl):
         cl.PostUploadUpdates(options, new_upload, change_numbers[i])
 
@@ -5951,6 +6551,7 @@ def CMDsplit(parser, args):
     def WrappedCMDupload(args):
         return CMDupload(OptionParser(), args)
 
+    import split_cl
     return split_cl.SplitCl(options.description_file, options.comment_file,
                             Changelist, WrappedCMDupload, options.dry_run,
                             options.summarize, options.reviewers,
@@ -6469,7 +7070,7 @@ def CMDset_commit(parser, args):
     options, args = parser.parse_args(args)
     if args:
         parser.error('Unrecognized args: %s' % ' '.join(args))
-    if [options.dry_run, options.clear].count(True) > 1:
+    if options.dry_run and options.clear:
         parser.error('Only one of --dry-run, and --clear are allowed.')
 
     cl = Changelist(issue=options.issue)
@@ -6541,7 +7142,7 @@ def CMDdiff(parser, args):
     if not base:
         base = cl._GitGetBranchConfigValue(GERRIT_SQUASH_HASH_CONFIG_KEY)
     if not base:
-        detail = cl._GetChangeDetail(['CURRENT_REVISION', 'CURRENT_COMMIT'])
+        detail = cl._GetChangeDetail(_CURRENT_REVISION_OPTS)
         revision_info = detail['revisions'][detail['current_revision']]
         fetch_info = revision_info['fetch']['http']
         RunGit(['fetch', fetch_info['url'], fetch_info['ref']])
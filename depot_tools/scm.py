@@ -641,6 +641,9 @@ class GIT(object):
     # single subcommand, which can greatly accelerate things like
     # git-map-branches.
     _CONFIG_CACHE: Dict[pathlib.Path, Optional[CachedGitConfigState]] = {}
+    # Maps absolute cwd strings, as passed by callers, to the same states, so
+    # repeated lookups for e.g. the checkout root skip resolving the path.
+    _CONFIG_CACHE_BY_CWD: Dict[str, CachedGitConfigState] = {}
     _CONFIG_CACHE_LOCK = threading.Lock()
 
     @classmethod
@@ -652,6 +655,7 @@ class GIT(object):
         """
         with cls._CONFIG_CACHE_LOCK:
             cls._CONFIG_CACHE = {}
+            cls._CONFIG_CACHE_BY_CWD = {}
 
     @staticmethod
     def _new_config_state(root: pathlib.Path) -> GitConfigStateBase:
@@ -661,14 +665,19 @@ class GIT(object):
 
     @classmethod
     def _get_config_state(cls, cwd: str) -> CachedGitConfigState:
-        key = pathlib.Path(cwd).absolute()
         with cls._CONFIG_CACHE_LOCK:
-            cur = GIT._CONFIG_CACHE.get(key, None)
+            cur = cls._CONFIG_CACHE_BY_CWD.get(cwd, None)
             if cur is not None:
                 return cur
-            ret = CachedGitConfigState(cls._new_config_state(key))
-            cls._CONFIG_CACHE[key] = ret
-            return ret
+            key = pathlib.Path(cwd).absolute()
+            cur = GIT._CONFIG_CACHE.get(key, None)
+            if cur is None:
+                cur = CachedGitConfigState(cls._new_config_state(key))
+                cls._CONFIG_CACHE[key] = cur
+            # Relative paths depend on the current directory, which may change.
+            if os.path.isabs(cwd):
+                cls._CONFIG_CACHE_BY_CWD[cwd] = cur
+            return cur
 
     @classmethod
     def _dump_config_state(cls) -> Dict[str, GitFlatConfigData]:
@@ -483,6 +483,34 @@ class GerritUtilTest(unittest.TestCase):
         content = gerrit_util.ReadHttpResponse(conn, (404, ))
         self.assertEqual('', content.getvalue())
 
+    @mock.patch('gerrit_util.CreateHttpConn')
+    def testGetChangeDetailIfModified(self, mockCreateHttpConn):
+        response = mock.Mock(status=200)
+        response.get.return_value = 'etag'
+        conn = mock.Mock(req_params={'uri': 'uri', 'method': 'method'})
+        conn.request.return_value = (response, b')]}\'\n{"status": "NEW"}')
+        mockCreateHttpConn.return_value = conn
+
+        self.assertEqual(('etag', {
+            'status': 'NEW'
+        }), gerrit_util.GetChangeDetailIfModified('host', 'change', ['A']))
+        mockCreateHttpConn.assert_called_once_with('host',
+                                                   'changes/change/detail?o=A',
+                                                   headers=None)
+        response.get.assert_called_once_with('etag')
+
+    @mock.patch('gerrit_util.CreateHttpConn')
+    def testGetChangeDetailIfModified_NotModified(self, mockCreateHttpConn):
+        conn = mock.Mock(req_params={'uri': 'uri', 'method': 'method'})
+        conn.request.return_value = (mock.Mock(status=304), b'')
+        mockCreateHttpConn.return_value = conn
+
+        self.assertEqual(('etag', None),
+                         gerrit_util.GetChangeDetailIfModified(
+                             'host', 'change', etag='etag'))
+        mockCreateHttpConn.assert_called_once_with(
+            'host', 'changes/change/detail', headers={'If-None-Match': 'etag'})
+
     @mock.patch('gerrit_util.ReadHttpResponse')
     def testReadHttpJsonResponse_NotJSON(self, mockReadHttpResponse):
         mockReadHttpResponse.return_value = StringIO('not json')
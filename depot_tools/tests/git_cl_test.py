@@ -9,14 +9,19 @@ import codecs
 import datetime
 import json
 import logging
-import multiprocessing
+import multiprocessing.pool
 import optparse
 import os
 import io
 import shutil
+import sqlite3
+import stat
 import sys
 import tempfile
+import threading
 import unittest
+import urllib.parse
+import zipfile
 
 from unittest import mock
 
@@ -63,6 +68,18 @@ def getAccountDetailsMock(host, account_id='self', *, authenticator=None):
     return None
 
 
+def runGitPushMock(output):
+    """Returns a fake Changelist._RunGitPushWithTraces whose push prints
+    `output`, collecting change numbers the way the real one does."""
+    def run_git_push(*_args, change_numbers=None):
+        if change_numbers is not None:
+            change_numbers.extend(
+                git_cl._GERRIT_CHANGE_URL_RE.findall(output.decode()))
+        return output
+
+    return run_git_push
+
+
 class TemporaryFileMock(object):
     def __init__(self):
         self.suffix = 0
@@ -207,9 +224,13 @@ class TestGitClBasic(unittest.TestCase):
         cl.description = 'x'
         self.assertEqual(cl.FetchDescription(), 'x')
 
+    @mock.patch('git_cl.Changelist.GetCodereviewServer',
+                return_value='https://chromium-review.googlesource.com')
+    @mock.patch('git_cl.Changelist.GetRemoteUrl',
+                return_value='https://chromium.googlesource.com/src')
     @mock.patch('git_cl.Changelist.EnsureAuthenticated')
     @mock.patch('git_cl.Changelist.GetStatus', lambda cl: cl.status)
-    def test_get_cl_statuses(self, *_mocks):
+    def test_get_cl_statuses(self, mockEnsureAuthenticated, *_mocks):
         statuses = [
             'closed', 'commit', 'dry-run', 'lgtm', 'reply', 'unsent', 'waiting'
         ]
@@ -221,6 +242,8 @@ class TestGitClBasic(unittest.TestCase):
 
         actual = set(git_cl.get_cl_statuses(changes, True))
         self.assertEqual(set(zip(changes, statuses)), actual)
+        # All branches share a remote, so credentials are checked once.
+        mockEnsureAuthenticated.assert_called_once_with(force=False)
 
     def test_upload_to_non_default_branch_no_retry(self):
         m = mock.patch('git_cl.Changelist._CMDUploadChange',
@@ -279,6 +302,8 @@ class TestGitClBasic(unittest.TestCase):
                    return_value='foo').start()
         mock.patch('git_cl.gerrit_util.GetProjectHead',
                    return_value='refs/heads/main').start()
+        mockPopen = mock.patch('git_cl.subprocess2.Popen').start()
+        mockPopen.return_value.communicate.return_value = (b'', None)
 
         cl = git_cl.Changelist()
         options = optparse.Values()
@@ -290,10 +315,63 @@ class TestGitClBasic(unittest.TestCase):
         # ensure upload is called once
         self.assertEqual(len(m.mock_calls), 1)
         sys.exit.assert_called_once_with(1)
+        # The fetch is only needed for a retry, so it was stopped.
+        mockPopen.return_value.kill.assert_called_once_with()
         # option not set as retry didn't happen
         self.assertFalse(hasattr(options, 'force'))
         self.assertFalse(hasattr(options, 'edit_description'))
 
+    def test_upload_to_old_default_project_head_fails(self):
+        mock.patch('git_cl.Changelist._CMDUploadChange',
+                   side_effect=git_cl.GitPushError()).start()
+        mock.patch('git_cl.Changelist.GetRemoteBranch',
+                   return_value=('foo', git_cl.DEFAULT_OLD_BRANCH)).start()
+        mock.patch('git_cl.Changelist.GetGerritProject',
+                   return_value='foo').start()
+        mock.patch('git_cl.gerrit_util.GetProjectHead',
+                   side_effect=gerrit_util.GerritError(500, 'error')).start()
+        mockPopen = mock.patch('git_cl.subprocess2.Popen').start()
+        mockPopen.return_value.communicate.return_value = (b'', None)
+
+        cl = git_cl.Changelist()
+        options = optparse.Values()
+        options.target_branch = None
+        with self.assertRaises(gerrit_util.GerritError):
+            cl.CMDUploadChange(options, [], 'foo',
+                               git_cl.ChangeDescription('bar'))
+
+        mockPopen.return_value.kill.assert_called_once_with()
+
+    def test_upload_to_old_default_retry(self):
+        m = mock.patch('git_cl.Changelist._CMDUploadChange',
+                       side_effect=[git_cl.GitPushError(), None]).start()
+        mock.patch('git_cl.Changelist.GetRemoteBranch',
+                   return_value=('foo', git_cl.DEFAULT_OLD_BRANCH)).start()
+        mock.patch('git_cl.Changelist.GetGerritProject',
+                   return_value='foo').start()
+        mock.patch('git_cl.gerrit_util.GetProjectHead',
+                   return_value='refs/heads/main').start()
+        mock.patch('sys.stdout', io.StringIO()).start()
+        mockPopen = mock.patch('git_cl.subprocess2.Popen').start()
+        mockPopen.return_value.communicate.return_value = (b'', None)
+        mockPopen.return_value.returncode = 0
+
+        cl = git_cl.Changelist()
+        options = optparse.Values()
+        options.target_branch = None
+        change_desc = git_cl.ChangeDescription('bar')
+        cl.CMDUploadChange(options, [], 'foo', change_desc)
+
+        mockPopen.assert_called_once_with(['git', 'fetch', '--prune', 'foo'],
+                                          env=mock.ANY,
+                                          stdout=subprocess2.PIPE)
+        mockPopen.return_value.kill.assert_not_called()
+        self.assertEqual(2, len(m.mock_calls))
+        m.assert_called_with(options, [], 'foo', change_desc,
+                             'refs/heads/main')
+        self.assertTrue(options.force)
+        self.assertFalse(options.edit_description)
+
     def test_upload_with_message_file_no_editor(self):
         m = mock.patch('git_cl.ChangeDescription.prompt',
                        return_value=None).start()
@@ -333,19 +411,31 @@ class TestGitClBasic(unittest.TestCase):
     def test_get_cl_statuses_no_changes(self):
         self.assertEqual([], list(git_cl.get_cl_statuses([], True)))
 
+    @mock.patch('git_cl.Changelist.GetRemoteUrl', return_value=None)
     @mock.patch('git_cl.Changelist.EnsureAuthenticated')
-    @mock.patch('multiprocessing.pool.ThreadPool')
     def test_get_cl_statuses_timeout(self, *_mocks):
-        changes = [git_cl.Changelist() for _ in range(2)]
-        pool = multiprocessing.pool.ThreadPool()
-        it = pool.imap_unordered.return_value.__iter__ = mock.Mock()
-        it.return_value.next.side_effect = [
-            (changes[0], 'lgtm'),
-            multiprocessing.TimeoutError,
-        ]
+        changes = [git_cl.Changelist() for _ in range(3)]
+        unblock = threading.Event()
+        self.addCleanup(unblock.set)
+
+        def get_status(cl):
+            if cl is changes[0]:
+                return 'lgtm'
+            if cl is changes[1]:
+                raise gerrit_util.GerritError(500, 'Internal error')
+            unblock.wait()
+            return 'waiting'
+
+        mock.patch('git_cl.Changelist.GetStatus', get_status).start()
+        mock.patch('logging.exception').start()
+        next_result = multiprocessing.pool.IMapIterator.next
+        mock.patch('multiprocessing.pool.IMapIterator.next',
+                   lambda it, timeout=None: next_result(it, 0.1)).start()
 
         actual = list(git_cl.get_cl_statuses(changes, True))
-        self.assertEqual([(changes[0], 'lgtm'), (changes[1], 'error')], actual)
+        self.assertEqual({(changes[0], 'lgtm'), (changes[1], 'error')},
+                         set(actual[:2]))
+        self.assertEqual([(changes[2], 'error')], actual[2:])
 
     @mock.patch('git_cl.Changelist.GetIssueURL')
     def test_get_cl_statuses_not_finegrained(self, _mock):
@@ -357,6 +447,161 @@ class TestGitClBasic(unittest.TestCase):
         self.assertEqual(set([(changes[0], 'waiting'), (changes[1], 'error')]),
                          actual)
 
+    def test_split_remote_url(self):
+        for url in [
+                'https://chromium.googlesource.com/a/chromium/src.git',
+                'sso://chromium/chromium/src',
+                'ssh://user@host.com:29418/project',
+                'https://host.com',
+                'file:///tmp/repo',
+                'https://host.com/path?query#fragment',
+        ]:
+            parsed_url = urllib.parse.urlparse(url)
+            self.assertEqual(
+                (parsed_url.scheme, parsed_url.netloc, parsed_url.path),
+                git_cl._split_remote_url(url))
+        self.assertEqual(('', '', ''), git_cl._split_remote_url(None))
+
+    def test_gerrit_change_url_re(self):
+        push_output = (
+            'remote: Processing changes: new: 1, done\n'
+            'remote:\n'
+            'remote: New Changes:\n'
+            'remote:   https://chromium-review.googlesource.com/c/chromium/'
+            'src/+/1234 Add a goat\n'
+            'remote:   https://review.example.org/5678 [WIP] Pet the goat\n'
+            'To https://chromium.googlesource.com/chromium/src\n')
+        self.assertEqual(['1234', '5678'],
+                         git_cl._GERRIT_CHANGE_URL_RE.findall(push_output))
+
+    def test_build_refspec_suffix(self):
+        self.assertEqual('', git_cl._BuildRefSpecSuffix([]))
+        self.assertEqual(
+            '%ready,r=a@example.com,cc=b@example.com',
+            git_cl._BuildRefSpecSuffix(
+                ['ready', 'r=a@example.com', 'cc=b@example.com', 'ready']))
+        with self.assertRaises(AssertionError):
+            git_cl._BuildRefSpecSuffix(['m=has space'])
+
+    def test_write_json_iter(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'out.json')
+        for items in ([], [{'a': 1}], [{'a': 1}, 'b', [2, 3]]):
+            git_cl.write_json_iter(path, iter(items))
+            with open(path) as f:
+                self.assertEqual(json.dumps(items), f.read())
+
+    def test_cleanup_list(self):
+        self.assertEqual([], git_cl.cleanup_list([]))
+        self.assertEqual(['joa@c', 'joe@c', 'john@c'],
+                         git_cl.cleanup_list(['joe@c, john@c,', ' joa@c ']))
+
+    @mock.patch('git_cl.CMDstatus.__doc__',
+                'Status.\n\n    - Blue  waiting\n    - Red   failed\n')
+    def test_colorize_cmdstatus_doc(self):
+        mock.patch.object(git_cl.CMDstatus,
+                          'doc_colorized',
+                          False,
+                          create=True).start()
+        expected = ('Status.\n\n    -' + git_cl.Fore.BLUE + ' Blue  waiting' +
+                    git_cl.Fore.RESET + '\n    -' + git_cl.Fore.RED +
+                    ' Red   failed' + git_cl.Fore.RESET + '\n')
+        git_cl.colorize_CMDstatus_doc()
+        self.assertEqual(expected, git_cl.CMDstatus.__doc__)
+        # Colorizing again must not nest the escape codes.
+        git_cl.colorize_CMDstatus_doc()
+        self.assertEqual(expected, git_cl.CMDstatus.__doc__)
+
+    def test_shorten_git_hashes(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'trace-packet')
+        with open(path, 'w') as f:
+            f.write('git-hash: 0123456789012345678901234567890123456789\n'
+                    'git-hash: abcdeabcdeabcdeabcdeabcdeabcdeabcdeabcde\n'
+                    'not-a-hash: 0123456789\n')
+
+        git_cl._shorten_git_hashes(path)
+
+        with open(path) as f:
+            self.assertEqual(
+                'git-hash: 012345\n'
+                'git-hash: abcdea\n'
+                'not-a-hash: 0123456789\n', f.read())
+        self.assertEqual(['trace-packet'], os.listdir(temp_dir))
+
+    def test_make_zip_archive(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        root_dir = os.path.join(temp_dir, 'root')
+        os.makedirs(os.path.join(root_dir, 'sub'))
+        for name in ('a', os.path.join('sub', 'b')):
+            with open(os.path.join(root_dir, name), 'w') as f:
+                f.write(name)
+
+        git_cl._make_zip_archive(os.path.join(temp_dir, 'archive'), root_dir)
+
+        with zipfile.ZipFile(os.path.join(temp_dir, 'archive.zip')) as zf:
+            self.assertEqual(['a', 'sub/b'], sorted(zf.namelist()))
+            self.assertEqual(b'a', zf.read('a'))
+
+    def test_clean_up_old_traces(self):
+        traces_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, traces_dir)
+        mock.patch('git_cl.TRACES_DIR', traces_dir).start()
+        mock.patch('git_cl.MAX_TRACES', 2).start()
+        os.mkdir(os.path.join(traces_dir, '1-dir'))
+        for name in ('2-traces.zip', '3-README', '4-traces.zip', 'tmpfile'):
+            with open(os.path.join(traces_dir, name), 'w'):
+                pass
+
+        git_cl.Changelist()._CleanUpOldTraces()
+
+        self.assertEqual(['1-dir', '3-README', '4-traces.zip', 'tmpfile'],
+                         sorted(os.listdir(traces_dir)))
+
+    def test_clean_up_old_traces_already_removed(self):
+        traces_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, traces_dir)
+        mock.patch('git_cl.TRACES_DIR', traces_dir).start()
+        mock.patch('git_cl.MAX_TRACES', 1).start()
+        for name in ('1-traces.zip', '2-traces.zip'):
+            with open(os.path.join(traces_dir, name), 'w'):
+                pass
+        # Another upload pruned the same trace first.
+        mock.patch('os.remove', side_effect=FileNotFoundError).start()
+        mock.patch('sys.stdout', io.StringIO()).start()
+
+        git_cl.Changelist()._CleanUpOldTraces()
+
+        self.assertEqual('', sys.stdout.getvalue())
+
+    @mock.patch('git_cl.RunGit')
+    def test_resolve_git_objects(self, mockRunGit):
+        mockRunGit.return_value = 'deadbeef\nfoo: missing\n'
+        self.assertEqual(['deadbeef', None],
+                         git_cl.ResolveGitObjects(['HEAD:', 'foo:']))
+        mockRunGit.assert_called_once_with(
+            ['cat-file', '--batch-check=%(objectname)'],
+            stdin=b'HEAD:\nfoo:\n',
+            error_ok=True)
+
+    @mock.patch('git_cl.Changelist._CleanUpOldTraces')
+    @mock.patch('git_cl.Changelist._WriteGitPushTraces')
+    @mock.patch('gclient_utils.rmtree')
+    def test_finalize_git_push_traces(self, mockRmtree, mockWriteTraces, _):
+        traces_dir = tempfile.mkdtemp()
+        for name in ('tr2-event', 'trace-packet'):
+            with open(os.path.join(traces_dir, name), 'w'):
+                pass
+
+        git_cl.Changelist()._FinalizeGitPushTraces('trace', traces_dir, {})
+
+        mockWriteTraces.assert_called_once_with('trace', traces_dir, {})
+        self.assertFalse(os.path.exists(traces_dir))
+        mockRmtree.assert_not_called()
+
     def test_get_issue_url(self):
         cl = git_cl.Changelist(issue=123)
         cl._gerrit_server = 'https://example.com'
@@ -413,6 +658,159 @@ class TestGitClBasic(unittest.TestCase):
                          ['v8:456', 'chromium:123', 'v8:123'])
         self.assertEqual(f('v8', 'chromium:123,456,v8:123'),
                          ['v8:456', 'chromium:123', 'v8:123'])
+        # Numbers are normalized, anything else is kept as is.
+        self.assertEqual(f('v8', '0456, b/789,,123'),
+                         ['v8:456,123', 'b/789'])
+
+    @mock.patch('urllib.request.urlopen')
+    def test_download_gerrit_hook(self, mockUrlopen):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        hooks_dir = os.path.join(root, '.git', 'hooks')
+        os.makedirs(hooks_dir)
+        mock.patch('git_cl.Settings.GetRoot', return_value=root).start()
+        hook = os.path.join(hooks_dir, 'commit-msg')
+
+        mockUrlopen.return_value = io.BytesIO(b'not a script')
+        with self.assertRaises(SystemExitMock):
+            git_cl.DownloadGerritHook(False)
+        self.assertEqual([], os.listdir(hooks_dir))
+
+        mockUrlopen.return_value = io.BytesIO(b'#!/bin/sh\nexit 0\n')
+        git_cl.DownloadGerritHook(False)
+        self.assertEqual(['commit-msg'], os.listdir(hooks_dir))
+        self.assertTrue(os.access(hook, os.X_OK))
+        with open(hook, 'rb') as f:
+            self.assertEqual(b'#!/bin/sh\nexit 0\n', f.read())
+
+    def test_change_detail_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'cache', 'change_details.db')
+        cache = git_cl._ChangeDetailCache(path)
+        self.assertEqual((None, None), cache.Get('host', 123, {'LABELS'}))
+
+        connect = sqlite3.connect
+        mockConnect = mock.patch('sqlite3.connect',
+                                 side_effect=connect).start()
+        cache.Put('host', 123, {'LABELS'}, 'etag', {'status': 'NEW'})
+        # The expiry and the insert share a connection, and the schema is
+        # only set up once.
+        mockConnect.assert_called_once_with(path, timeout=5)
+        self.assertEqual(('etag', {
+            'status': 'NEW'
+        }), cache.Get('host', 123, {'LABELS'}))
+
+        cache.Invalidate('host', 123)
+        self.assertEqual((None, None), cache.Get('host', 123, {'LABELS'}))
+
+    @unittest.skipIf(sys.platform == 'win32', 'POSIX file modes only')
+    def test_change_detail_cache_is_private(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        cache_dir = os.path.join(temp_dir, 'cache')
+        os.mkdir(cache_dir, 0o755)
+        path = os.path.join(cache_dir, 'change_details.db')
+        with open(path, 'w'):
+            pass
+        os.chmod(path, 0o644)
+        cache = git_cl._ChangeDetailCache(path)
+        mock.patch.object(git_cl._ChangeDetailCache, '_prepared_paths',
+                          set()).start()
+
+        cache.Put('host', 123, {'LABELS'}, 'etag', {'status': 'NEW'})
+
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(cache_dir).st_mode))
+        for name in os.listdir(cache_dir):
+            self.assertEqual(
+                0o600, stat.S_IMODE(os.stat(os.path.join(cache_dir,
+                                                         name)).st_mode),
+                name)
+
+    @mock.patch('git_cl.RunGit')
+    @mock.patch('subprocess2.Popen')
+    def test_start_stats(self, mockPopen, mockRunGit):
+        for is_tty, colorbool, color_args in ((False, None, []),
+                                              (True, 'false\n', []),
+                                              (True, 'true\n', ['--color'])):
+            mockPopen.reset_mock()
+            mockRunGit.reset_mock()
+            mockRunGit.return_value = colorbool
+            mock.patch('git_cl.setup_color.IS_TTY', is_tty).start()
+            self.assertEqual(mockPopen.return_value,
+                             git_cl.start_stats(['base', 'HEAD']))
+            mockPopen.assert_called_once_with(
+                ['git', 'diff', '--no-ext-diff', '--stat', '-l100000', '-C50'] +
+                color_args + ['base', 'HEAD'],
+                env=mock.ANY,
+                stdout=subprocess2.PIPE,
+                stderr=subprocess2.PIPE)
+            if is_tty:
+                # color.diff and color.ui are honored.
+                mockRunGit.assert_called_once_with(
+                    ['config', '--get-colorbool', 'color.diff', 'true'],
+                    error_ok=True)
+            else:
+                mockRunGit.assert_not_called()
+
+    @mock.patch('git_cl.RunGitWithCode')
+    def test_get_commit_count(self, mockRunGitWithCode):
+        mockRunGitWithCode.return_value = (0, '3\n')
+        self.assertEqual(3, git_cl._GetCommitCount('origin/main'))
+        mockRunGitWithCode.assert_called_once_with(
+            ['rev-list', '--count', 'origin/main..HEAD'], suppress_stderr=True)
+
+        # e.g. --no-squash uploads pass origin/refs/heads/main, which git
+        # can't resolve.
+        mockRunGitWithCode.return_value = (128, '')
+        self.assertEqual(
+            0, git_cl._GetCommitCount('origin/refs/heads/main', 'HEAD'))
+
+    def test_has_shebang(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'hook')
+        for content, expected in ((b'#!/bin/sh\n', True), (b'#', False),
+                                  (b'\xff\xfe#!', False)):
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.assertEqual(expected, git_cl.hasSheBang(path))
+
+    @mock.patch('git_cl.urlretrieve')
+    def test_download_gerrit_hook_existing(self, mockUrlretrieve):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        hooks_dir = os.path.join(root, '.git', 'hooks')
+        os.makedirs(hooks_dir)
+        mock.patch('git_cl.Settings.GetRoot', return_value=root).start()
+        hook = os.path.join(hooks_dir, 'commit-msg')
+        with open(hook, 'w') as f:
+            f.write('#!/bin/sh\n')
+
+        # A hook that isn't executable is only replaced when forced.
+        os.chmod(hook, stat.S_IRUSR | stat.S_IWUSR)
+        git_cl.DownloadGerritHook(False)
+        mockUrlretrieve.assert_not_called()
+
+        # An executable hook is never replaced.
+        os.chmod(hook, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+        git_cl.DownloadGerritHook(True)
+        mockUrlretrieve.assert_not_called()
+
+    def test_find_codereview_settings_file(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        cwd = os.path.join(root, 'a', 'b')
+        os.makedirs(os.path.join(cwd, 'codereview.settings'))
+        with open(os.path.join(root, 'a', 'codereview.settings'), 'w') as f:
+            f.write('GERRIT_HOST: True\n')
+        mock.patch('os.getcwd', return_value=cwd).start()
+        mock.patch('git_cl.Settings.GetRoot', return_value=root).start()
+
+        # The directory named like the settings file is skipped.
+        with git_cl.FindCodereviewSettingsFile() as f:
+            self.assertEqual('GERRIT_HOST: True\n', f.read())
+        self.assertIsNone(git_cl.FindCodereviewSettingsFile('missing'))
 
     @mock.patch('gerrit_util.GetAccountDetails')
     def test_valid_accounts(self, mockGetAccountDetails):
@@ -569,6 +967,33 @@ class GitCookiesCheckerTest(unittest.TestCase):
                 'partial.googlesource.com', 'gpartial-review.googlesource.com'
             ]), self.c.get_partially_configured_hosts())
 
+    def test_identity_pairs_cached(self):
+        self.mock_hosts_creds([
+            ('conflict', 'git-example.google.com'),
+            ('conflict-review', 'git-example.chromium.org'),
+        ])
+        pairs = self.c._get_git_gerrit_identity_pairs()
+        self.assertEqual(
+            {
+                'conflict.googlesource.com':
+                ['git-example.google.com', 'git-example.chromium.org']
+            }, pairs)
+        self.assertIs(pairs, self.c._get_git_gerrit_identity_pairs())
+
+    def test_report_builds_identity_pairs_once(self):
+        self.mock_hosts_creds([
+            ('conflict', 'git-example.google.com'),
+            ('conflict-review', 'git-example.chromium.org'),
+            ('partial', 'git-example.google.com'),
+        ])
+        with mock.patch.object(self.c,
+                               'get_hosts_with_creds',
+                               wraps=self.c.get_hosts_with_creds) as m:
+            self.assertTrue(self.c.find_and_report_problems())
+        # Read once each by has_generic_host, get_duplicated_hosts and the
+        # identity pairs shared by the partial and conflicting host checks.
+        self.assertEqual(3, m.call_count)
+
     def test_report_no_problems(self):
         self.test_analysis_nothing()
         self.assertFalse(self.c.find_and_report_problems())
@@ -617,7 +1042,7 @@ class TestGitCl(unittest.TestCase):
         mock.patch('subprocess2.communicate', lambda *a, **_k:
                    ([self._mocked_call(*a), ''], 0)).start()
         mock.patch('git_cl.gclient_utils.CheckCallAndFilter',
-                   self._mocked_call).start()
+                   self._mocked_check_call_and_filter).start()
         mock.patch('git_common.is_dirty_git_tree', lambda x: False).start()
         mock.patch('git_cl.FindCodereviewSettingsFile', return_value='').start()
         mock.patch(
@@ -625,6 +1050,9 @@ class TestGitCl(unittest.TestCase):
             lambda _: self._mocked_call('SaveDescriptionBackup')).start()
         mock.patch('git_cl.write_json',
                    lambda *a: self._mocked_call('write_json', *a)).start()
+        mock.patch(
+            'git_cl.write_json_iter', lambda path, items: self._mocked_call(
+                'write_json_iter', path, list(items))).start()
         mock.patch('git_cl.Changelist.RunHook',
                    return_value={
                        'more_cc': ['test-more-cc@chromium.org']
@@ -679,6 +1107,13 @@ class TestGitCl(unittest.TestCase):
         finally:
             super(TestGitCl, self).tearDown()
 
+    def _mocked_check_call_and_filter(self, *args, filter_fn=None, **kwargs):
+        result = self._mocked_call(*args, **kwargs)
+        if filter_fn:
+            for line in result.decode('utf-8').splitlines():
+                filter_fn(line)
+        return result
+
     def _mocked_call(self, *args, **_kwargs):
         self.assertTrue(
             self.calls, '@%d  Expected: <Missing>   Actual: %r' %
@@ -804,9 +1239,8 @@ class TestGitCl(unittest.TestCase):
         ]
 
         calls += [
-            ((['git', 'diff', '--no-ext-diff', '--stat', '-l100000', '-C50'] +
-              ([custom_cl_base]
-               if custom_cl_base else [ancestor_revision, 'HEAD']), ), '+dat'),
+            (('start_stats', [custom_cl_base]
+              if custom_cl_base else [ancestor_revision, 'HEAD']), b'+dat'),
         ]
         return calls
 
@@ -883,10 +1317,8 @@ class TestGitCl(unittest.TestCase):
                     (['git', 'rev-parse',
                       'HEAD:'], ),  # `HEAD:` means HEAD's tree hash.
                     '0123456789abcdef'),
-                ((['FileWrite', '/tmp/fake-temp1', description], ), None),
                 (([
-                    'git', 'commit-tree', '0123456789abcdef', '-p', parent,
-                    '-F', '/tmp/fake-temp1'
+                    'git', 'commit-tree', '0123456789abcdef', '-p', parent
                 ], ), ref_to_push),
             ]
         else:
@@ -895,8 +1327,8 @@ class TestGitCl(unittest.TestCase):
 
         calls += [
             (('SaveDescriptionBackup', ), None),
-            ((['git', 'rev-list',
-               parent + '..' + ref_to_push], ), '1hashPerLine\n'),
+            ((['git', 'rev-list', '--count',
+               parent + '..' + ref_to_push], ), '1\n'),
         ]
 
         metrics_arguments = []
@@ -1047,23 +1479,13 @@ class TestGitCl(unittest.TestCase):
                 True,
             ),
             (
-                (['FileRead',
+                (['_shorten_git_hashes',
                   os.path.join('TEMP_DIR', 'trace-packet')], ),
-                ('git-hash: 0123456789012345678901234567890123456789\n'
-                 'git-hash: abcdeabcdeabcdeabcdeabcdeabcdeabcdeabcde\n'),
-            ),
-            (
-                ([
-                    'FileWrite',
-                    os.path.join('TEMP_DIR', 'trace-packet'),
-                    'git-hash: 012345\n'
-                    'git-hash: abcdea\n'
-                ], ),
                 None,
             ),
             # Make zip file for the git traces.
             (
-                (['make_archive', trace_name + '-traces', 'zip', 'TEMP_DIR'], ),
+                (['_make_zip_archive', trace_name + '-traces', 'TEMP_DIR'], ),
                 None,
             ),
             # Collect git config and gitcookies.
@@ -1115,8 +1537,7 @@ class TestGitCl(unittest.TestCase):
         calls += [
             # Make zip file for the git config and gitcookies.
             (
-                (['make_archive', trace_name + '-git-info', 'zip',
-                  'TEMP_DIR'], ),
+                (['_make_zip_archive', trace_name + '-git-info', 'TEMP_DIR'], ),
                 None,
             ),
         ]
@@ -1191,6 +1612,14 @@ class TestGitCl(unittest.TestCase):
             'git_cl.datetime_now',
             lambda: datetime.datetime(2017, 3, 16, 20, 0, 41, 0)).start()
         mock.patch('git_cl.tempfile.mkdtemp', lambda: 'TEMP_DIR').start()
+        mock.patch('git_cl.run_in_background',
+                   lambda fn, *args: fn(*args)).start()
+        mock.patch(
+            'git_cl.start_stats', lambda args: mock.Mock(communicate=mock.Mock(
+                return_value=(self._mocked_call('start_stats', args), b'')))
+        ).start()
+        mock.patch('git_cl._shorten_git_hashes', lambda path: self.
+                   _mocked_call(['_shorten_git_hashes', path])).start()
         mock.patch('git_cl.TRACES_DIR', 'TRACES_DIR').start()
         mock.patch(
             'git_cl.TRACES_README_FORMAT', '%(now)s\n'
@@ -1202,8 +1631,8 @@ class TestGitCl(unittest.TestCase):
             '%(exit_code)s\n'
             '%(trace_name)s').start()
         mock.patch(
-            'git_cl.shutil.make_archive', lambda *args: self._mocked_call(
-                ['make_archive'] + list(args))).start()
+            'git_cl._make_zip_archive', lambda *args: self._mocked_call(
+                ['_make_zip_archive'] + list(args))).start()
         mock.patch(
             'os.path.isfile',
             lambda path: self._mocked_call(['os.path.isfile', path])).start()
@@ -1342,9 +1771,9 @@ class TestGitCl(unittest.TestCase):
         options.push_options = ['uploadvalidator~skip']
         orig_args = []
 
-        mockRunGitPush.return_value = (
-            'remote:   https://chromium-review.'
-            'googlesource.com/c/chromium/circus/clown/+/1234 stonks')
+        mockRunGitPush.side_effect = runGitPushMock(
+            b'remote:   https://chromium-review.'
+            b'googlesource.com/c/chromium/circus/clown/+/1234 stonks')
 
         # Call
         git_cl.UploadAllSquashed(options, orig_args)
@@ -1356,8 +1785,10 @@ class TestGitCl(unittest.TestCase):
                             'm=honk_stonk,topic=circus,hashtag=cow')
         expected_refspec_opts = ['m=honk_stonk', 'topic=circus', 'hashtag=cow']
         mockRunGitPush.assert_called_once_with(expected_refspec,
-                                               expected_refspec_opts, mock.ANY,
-                                               options.push_options)
+                                               expected_refspec_opts,
+                                               mock.ANY,
+                                               options.push_options,
+                                               change_numbers=mock.ANY)
         mockPostUploadUpdates.assert_called_once_with(options, new_upload,
                                                       '1234')
 
@@ -1426,12 +1857,12 @@ class TestGitCl(unittest.TestCase):
         options.push_options = ['uploadvalidator~skip']
         orig_args = []
 
-        mockRunGitPush.return_value = (
-            'remote:   https://chromium-review.'
-            'googlesource.com/c/chromium/circus/clown/+/1233 kwak'
-            '\n'
-            'remote:   https://chromium-review.'
-            'googlesource.com/c/chromium/circus/clown/+/1234 stonks')
+        mockRunGitPush.side_effect = runGitPushMock(
+            b'remote:   https://chromium-review.'
+            b'googlesource.com/c/chromium/circus/clown/+/1233 kwak'
+            b'\n'
+            b'remote:   https://chromium-review.'
+            b'googlesource.com/c/chromium/circus/clown/+/1234 stonks')
 
         # Call
         git_cl.UploadAllSquashed(options, orig_args)
@@ -1453,8 +1884,10 @@ class TestGitCl(unittest.TestCase):
                             'topic=circus,hashtag=cow')
         expected_refspec_opts = ['topic=circus', 'hashtag=cow']
         mockRunGitPush.assert_called_once_with(expected_refspec,
-                                               expected_refspec_opts, mock.ANY,
-                                               options.push_options)
+                                               expected_refspec_opts,
+                                               mock.ANY,
+                                               options.push_options,
+                                               change_numbers=mock.ANY)
 
         self.assertEqual(mockPostUploadUpdates.mock_calls, [
             mock.call(options, new_upload_upstream, '1233'),
@@ -1517,9 +1950,9 @@ class TestGitCl(unittest.TestCase):
                                                change_desc, prev_patchset)
         mockSquashedCommit.return_value = new_upload_current
 
-        mockRunGitPush.return_value = (
-            'remote:   https://chromium-review.'
-            'googlesource.com/c/chromium/circus/clown/+/1233 kwak')
+        mockRunGitPush.side_effect = runGitPushMock(
+            b'remote:   https://chromium-review.'
+            b'googlesource.com/c/chromium/circus/clown/+/1233 kwak')
 
         # Test case: user wants to pull in external changes.
         mockExternalChanges.reset_mock()
@@ -1538,8 +1971,10 @@ class TestGitCl(unittest.TestCase):
                             'm=honk_stonk,topic=circus,hashtag=cow')
         expected_refspec_opts = ['m=honk_stonk', 'topic=circus', 'hashtag=cow']
         mockRunGitPush.assert_called_once_with(expected_refspec,
-                                               expected_refspec_opts, mock.ANY,
-                                               options.push_options)
+                                               expected_refspec_opts,
+                                               mock.ANY,
+                                               options.push_options,
+                                               change_numbers=mock.ANY)
 
         self.assertEqual(mockPostUploadUpdates.mock_calls,
                          [mock.call(options, new_upload_current, '1233')])
@@ -1973,6 +2408,16 @@ class TestGitCl(unittest.TestCase):
         # branches.
         self.assertEqual(5, len(git_cl.CMDupload.mock_calls))
         self.assertEqual(0, ret)
+        # Dependents are uploaded in preorder, then the root is checked out.
+        checkouts = [
+            c.args[0][2] for c in git_cl.RunGit.mock_calls
+            if c.args[0][:2] == ['checkout', '-q']
+        ]
+        self.assertEqual(
+            ['test2', 'test3', 'test4', 'test5', 'test3.1', 'test1'],
+            checkouts)
+        self.assertIn('  test2\n    test3\n      test4\n        test5\n'
+                      '    test3.1\n', sys.stdout.getvalue())
 
     def test_gerrit_change_id(self):
         self.calls = [
@@ -2264,6 +2709,15 @@ class TestGitCl(unittest.TestCase):
                 'refs/heads/main',
                 git_cl.GetTargetRef('origin', 'refs/remotes/branch-heads/123',
                                     branch))
+        # Remote names are matched literally, not as regexes.
+        self.assertEqual(
+            'refs/heads/main',
+            git_cl.GetTargetRef('my.fork', 'refs/remotes/my.fork/main',
+                                'my.fork/main'))
+        self.assertEqual(
+            'myXfork/main',
+            git_cl.GetTargetRef('my.fork', 'refs/remotes/my.fork/main',
+                                'myXfork/main'))
 
     @mock.patch('git_common.is_dirty_git_tree', return_value=True)
     def test_patch_when_dirty(self, *_mocks):
@@ -2714,10 +3168,9 @@ class TestGitCl(unittest.TestCase):
                     'not supported in non-git environment')
     def test_archive(self):
         self.calls = [
-            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'], ),
+            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads',
+               'refs/tags'], ),
              'refs/heads/main\nrefs/heads/foo\nrefs/heads/bar'),
-            ((['git', 'for-each-ref', '--format=%(refname)',
-               'refs/tags'], ), ''),
             ((['git', 'tag', 'git-cl-archived-456-foo', 'foo'], ), ''),
             ((['git', 'branch', '-D', 'foo'], ), '')
         ]
@@ -2736,10 +3189,10 @@ class TestGitCl(unittest.TestCase):
                     'not supported in non-git environment')
     def test_archive_tag_collision(self):
         self.calls = [
-            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'], ),
-             'refs/heads/main\nrefs/heads/foo\nrefs/heads/bar'),
-            ((['git', 'for-each-ref', '--format=%(refname)',
-               'refs/tags'], ), 'refs/tags/git-cl-archived-456-foo'),
+            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads',
+               'refs/tags'], ),
+             'refs/heads/main\nrefs/heads/foo\nrefs/heads/bar\n'
+             'refs/tags/git-cl-archived-456-foo'),
             ((['git', 'tag', 'git-cl-archived-456-foo-2', 'foo'], ), ''),
             ((['git', 'branch', '-D', 'foo'], ), '')
         ]
@@ -2754,14 +3207,45 @@ class TestGitCl(unittest.TestCase):
 
         self.assertEqual(0, git_cl.main(['archive', '-f']))
 
+    def test_get_archive_tag_for_branch(self):
+        tags = {'archived-1-foo', 'archived-1-foo-2'}
+        self.assertEqual(
+            'archived-1-foo-3',
+            git_cl.GetArchiveTagForBranch(1, 'foo', tags,
+                                          'archived-{issue}-{branch}'))
+        self.assertEqual(
+            'archived-1-bar',
+            git_cl.GetArchiveTagForBranch(1, 'bar', tags,
+                                          'archived-{issue}-{branch}'))
+        # Names handed out before are not reused.
+        self.assertEqual('archived',
+                         git_cl.GetArchiveTagForBranch(2, 'baz', tags,
+                                                       'archived'))
+        self.assertEqual('archived-2',
+                         git_cl.GetArchiveTagForBranch(3, 'qux', tags,
+                                                       'archived'))
+        self.assertEqual(
+            {
+                'archived-1-foo', 'archived-1-foo-2', 'archived-1-foo-3',
+                'archived-1-bar', 'archived', 'archived-2'
+            }, tags)
+
+    def test_get_archive_tag_for_branch_next_suffixes(self):
+        tags = {'archived', 'archived-2', 'archived-3'}
+        next_suffixes = {}
+        names = [
+            git_cl.GetArchiveTagForBranch(i, 'b', tags, 'archived',
+                                          next_suffixes) for i in range(3)
+        ]
+        self.assertEqual(['archived-4', 'archived-5', 'archived-6'], names)
+        self.assertEqual({'archived': 7}, next_suffixes)
+
     @unittest.skipIf(gclient_utils.IsEnvCog(),
                     'not supported in non-git environment')
     def test_archive_current_branch_fails(self):
         self.calls = [
-            ((['git', 'for-each-ref', '--format=%(refname)',
-               'refs/heads'], ), 'refs/heads/main'),
-            ((['git', 'for-each-ref', '--format=%(refname)',
-               'refs/tags'], ), ''),
+            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads',
+               'refs/tags'], ), 'refs/heads/main'),
         ]
 
         mock.patch(
@@ -2776,10 +3260,9 @@ class TestGitCl(unittest.TestCase):
                     'not supported in non-git environment')
     def test_archive_dry_run(self):
         self.calls = [
-            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'], ),
+            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads',
+               'refs/tags'], ),
              'refs/heads/main\nrefs/heads/foo\nrefs/heads/bar'),
-            ((['git', 'for-each-ref', '--format=%(refname)',
-               'refs/tags'], ), ''),
         ]
 
         mock.patch(
@@ -2796,10 +3279,10 @@ class TestGitCl(unittest.TestCase):
                     'not supported in non-git environment')
     def test_archive_no_tags(self):
         self.calls = [
-            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'], ),
+            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads',
+               'refs/tags'], ),
              'refs/heads/main\nrefs/heads/foo\nrefs/heads/bar'),
-            ((['git', 'for-each-ref', '--format=%(refname)',
-               'refs/tags'], ), ''), ((['git', 'branch', '-D', 'foo'], ), '')
+            ((['git', 'branch', '-D', 'foo'], ), '')
         ]
 
         mock.patch(
@@ -2816,10 +3299,9 @@ class TestGitCl(unittest.TestCase):
                     'not supported in non-git environment')
     def test_archive_tag_cleanup_on_branch_deletion_error(self):
         self.calls = [
-            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'], ),
+            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads',
+               'refs/tags'], ),
              'refs/heads/main\nrefs/heads/foo\nrefs/heads/bar'),
-            ((['git', 'for-each-ref', '--format=%(refname)',
-               'refs/tags'], ), ''),
             ((['git', 'tag', 'git-cl-archived-456-foo',
                'foo'], ), 'refs/tags/git-cl-archived-456-foo'),
             ((['git', 'branch', '-D', 'foo'], ), CERR1),
@@ -2841,10 +3323,9 @@ class TestGitCl(unittest.TestCase):
                     'not supported in non-git environment')
     def test_archive_with_format(self):
         self.calls = [
-            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'], ),
+            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads',
+               'refs/tags'], ),
              'refs/heads/main\nrefs/heads/foo\nrefs/heads/bar'),
-            ((['git', 'for-each-ref', '--format=%(refname)',
-               'refs/tags'], ), ''),
             ((['git', 'tag', 'archived/12-foo', 'foo'], ), ''),
             ((['git', 'branch', '-D', 'foo'], ), ''),
         ]
@@ -2859,6 +3340,43 @@ class TestGitCl(unittest.TestCase):
             0, git_cl.main(['archive', '-f', '-p',
                             'archived/{issue}-{branch}']))
 
+    @unittest.skipIf(gclient_utils.IsEnvCog(),
+                    'not supported in non-git environment')
+    @mock.patch('git_cl.get_cl_statuses', return_value=[])
+    def test_archive_skips_branches_without_issue(self, mockGetClStatuses):
+        self.calls = [
+            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads',
+               'refs/tags'], ),
+             'refs/heads/main\nrefs/heads/foo\nrefs/heads/bar'),
+        ]
+        scm.GIT.SetConfig('', 'branch.foo.gerritissue', '456')
+
+        self.assertEqual(0, git_cl.main(['archive', '-f']))
+        changes = mockGetClStatuses.call_args[0][0]
+        self.assertEqual(['foo'], [cl.GetBranch() for cl in changes])
+
+    @unittest.skipIf(gclient_utils.IsEnvCog(),
+                    'not supported in non-git environment')
+    def test_archive_tag_collision_between_branches(self):
+        self.calls = [
+            ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads',
+               'refs/tags'], ),
+             'refs/heads/main\nrefs/heads/foo\nrefs/heads/bar'),
+            ((['git', 'tag', 'archived', 'bar'], ), ''),
+            ((['git', 'branch', '-D', 'bar'], ), ''),
+            ((['git', 'tag', 'archived-2', 'foo'], ), ''),
+            ((['git', 'branch', '-D', 'foo'], ), ''),
+        ]
+
+        mock.patch(
+            'git_cl.get_cl_statuses',
+            lambda branches, fine_grained, max_processes: [
+                (MockChangelistWithBranchAndIssue('foo', 456), 'closed'),
+                (MockChangelistWithBranchAndIssue('bar', 789), 'closed'),
+            ]).start()
+
+        self.assertEqual(0, git_cl.main(['archive', '-f', '-p', 'archived']))
+
     @unittest.skipIf(gclient_utils.IsEnvCog(),
                      'not supported in non-git environment')
     def test_squash_closed(self):
@@ -2995,6 +3513,109 @@ class TestGitCl(unittest.TestCase):
         self.assertIsNone(scm.GIT.GetConfig('root', 'branch.main.gerritissue'))
         self.assertIsNone(scm.GIT.GetConfig('root', 'branch.main.gerritserver'))
 
+    @unittest.skipIf(gclient_utils.IsEnvCog(),
+                    'not supported in non-git environment')
+    @mock.patch('gerrit_util.GetAccountDetails')
+    def test_upload_git_completion_helper(self, mockGetAccountDetails):
+        # Shell completion must not run git or contact Gerrit; self.calls is
+        # empty, so any git invocation fails the test.
+        self.assertEqual(0, git_cl.main(['upload', '--git-completion-helper']))
+        mockGetAccountDetails.assert_not_called()
+        opts = sys.stdout.getvalue().split()
+        self.assertIn('--force', opts)
+        self.assertIn('--cherry-pick-stacked', opts)
+        self.assertNotIn('--git-completion-helper', opts)
+
+    @unittest.skipIf(gclient_utils.IsEnvCog(),
+                    'not supported in non-git environment')
+    def test_cmd_issue_reverse(self):
+        scm.GIT.SetConfig('', 'branch.main.gerritissue', '123')
+        scm.GIT.SetConfig('', 'branch.feature.v2.gerritissue', '456')
+        scm.GIT.SetConfig('', 'branch.other.gerritissue', '123')
+        scm.GIT.SetConfig('', 'branch.other.gerritserver',
+                          'https://chromium-review.googlesource.com')
+        # Left behind by a branch that no longer exists.
+        scm.GIT.SetConfig('', 'branch.deleted.gerritissue', '789')
+        self.calls = [
+            ((['git', 'for-each-ref', 'refs/heads', '--format=%(refname)'], ),
+             'refs/heads/main\nrefs/heads/feature.v2\nrefs/heads/other\n'),
+        ]
+        self.assertEqual(0, git_cl.main(['issue', '-r']))
+        self.assertEqual(
+            'Branch for issue number 123: refs/heads/main, refs/heads/other\n'
+            'Branch for issue number 456: refs/heads/feature.v2\n',
+            sys.stdout.getvalue())
+
+    @mock.patch('gerrit_util.GetChangeDetail')
+    @mock.patch('gerrit_util.CherryPick')
+    @mock.patch('gerrit_util.MultiQueryChanges')
+    def test_cmd_cherry_pick(self, mockMultiQueryChanges, mockCherryPick,
+                             mockGetChangeDetail):
+        mockMultiQueryChanges.return_value = [{
+            'id': 'id-' + commit,
+            'revisions': {
+                commit: {
+                    'commit': {
+                        'message': 'Subject ' + commit
+                    }
+                }
+            },
+        } for commit in ('c3', 'c1', 'c2')]
+        # Like Gerrit, the cherry-pick responses don't include the revision.
+        mockCherryPick.side_effect = [{
+            '_number': number
+        } for number in (201, 202, 203)]
+        mockGetChangeDetail.side_effect = lambda host, change, o_params: {
+            'current_revision': 'rev' + change
+        }
+
+        self.assertEqual(
+            0,
+            git_cl.main([
+                'cherry-pick', '--host', 'https://example.com', '--branch',
+                'refs/heads/main', '--parent-change-num', '100', 'c1', 'c2',
+                'c3'
+            ]))
+        mockMultiQueryChanges.assert_called_once_with(
+            'example.com', [], ['commit:c1', 'commit:c2', 'commit:c3'],
+            o_params=['CURRENT_REVISION', 'CURRENT_COMMIT'])
+        # The last CL isn't the parent of another cherry-pick, so its
+        # revision isn't needed.
+        self.assertEqual([
+            mock.call('example.com', '100', o_params=['CURRENT_REVISION']),
+            mock.call('example.com', '201', o_params=['CURRENT_REVISION']),
+            mock.call('example.com', '202', o_params=['CURRENT_REVISION']),
+        ], mockGetChangeDetail.call_args_list)
+        self.assertEqual(
+            ['rev100', 'rev201', 'rev202'],
+            [c.kwargs['base'] for c in mockCherryPick.call_args_list])
+        self.assertEqual(['id-c1', 'id-c2', 'id-c3'],
+                         [c.args[1] for c in mockCherryPick.call_args_list])
+
+    @mock.patch('gerrit_util.MultiQueryChanges')
+    def test_cmd_cherry_pick_ambiguous_commit(self, mockMultiQueryChanges):
+        mockMultiQueryChanges.return_value = [{
+            'id': change_id,
+            'revisions': {
+                'c1': {
+                    'commit': {
+                        'message': 'Subject'
+                    }
+                }
+            },
+        } for change_id in ('id1', 'id2')]
+        with self.assertRaisesRegex(RuntimeError,
+                                    'Multiple changes found for c1.'):
+            git_cl.main([
+                'cherry-pick', '--host', 'https://example.com', '--branch',
+                'refs/heads/main', 'c1'
+            ])
+        with self.assertRaisesRegex(RuntimeError, 'No changes found for c2.'):
+            git_cl.main([
+                'cherry-pick', '--host', 'https://example.com', '--branch',
+                'refs/heads/main', 'c2'
+            ])
+
     @unittest.skipIf(gclient_utils.IsEnvCog(),
                     'not supported in non-git environment')
     def test_cmd_issue_json(self):
@@ -3065,13 +3686,15 @@ class TestGitCl(unittest.TestCase):
         ]
         cl._GerritCommitMsgHookCheck(offer_removal=True)
 
-    def test_GerritCmdLand(self):
+    def test_GerritCmdLand(self, head='hash'):
         scm.GIT.SetConfig('', 'branch.main.gerritsquashhash', 'deadbeaf')
         scm.GIT.SetConfig('', 'branch.main.gerritserver',
                           'chromium-review.googlesource.com')
-        self.calls += [
-            ((['git', 'diff', 'deadbeaf'], ), ''),  # No diff.
-        ]
+        scm.GIT.ResolveCommit.return_value = head
+        if head != 'deadbeaf':
+            self.calls += [
+                ((['git', 'diff', '--quiet', 'deadbeaf'], ), ''),  # No diff.
+            ]
         cl = git_cl.Changelist(issue=123)
         cl._GetChangeDetail = lambda *args, **kwargs: {
             'labels': {},
@@ -3100,6 +3723,10 @@ class TestGitCl(unittest.TestCase):
         self.assertIn('Landed as: https://git.googlesource.com/test/+/deadbeef',
                       sys.stdout.getvalue())
 
+    def test_GerritCmdLand_HeadIsLastUpload(self):
+        # No git diff is needed when HEAD is the last uploaded commit.
+        self.test_GerritCmdLand(head='deadbeaf')
+
     def _mock_gerrit_changes_for_detail_cache(self):
         mock.patch('git_cl.Changelist.GetGerritHost', lambda _: 'host').start()
 
@@ -3134,6 +3761,19 @@ class TestGitCl(unittest.TestCase):
         self.assertEqual(cl._GetChangeDetail(options=['D']), 'ad')
         self.assertEqual(cl._GetChangeDetail(), 'cab')
 
+    def test_gerrit_change_detail_cache_frozen_options(self):
+        self._mock_gerrit_changes_for_detail_cache()
+        gerrit_util.GetChangeDetail.side_effect = ['rev']
+        cl = git_cl.Changelist(issue=1)
+        cl._cached_remote_url = (True,
+                                 'https://chromium.googlesource.com/repo/')
+        self.assertEqual(cl._GetChangeDetail(git_cl._CURRENT_REVISION_OPTS),
+                         'rev')
+        self.assertEqual(cl._GetChangeDetail(options=['CURRENT_REVISION']),
+                         'rev')
+        gerrit_util.GetChangeDetail.assert_called_once_with(
+            'host', 'repo~1', git_cl._CURRENT_REVISION_OPTS)
+
     def test_gerrit_description_caching(self):
         gerrit_util.GetChangeDetail.return_value = {
             'current_revision': 'rev1',
@@ -3280,36 +3920,35 @@ class TestGitCl(unittest.TestCase):
                 },
             ]
         }
-        self.calls = [
-            (('GetChangeComments', 'chromium-review.googlesource.com',
-              'infra%2Finfra~1'), {
-                  '/COMMIT_MSG': [
-                      {
-                          'author': {
-                              'email': u'reviewer@example.com'
-                          },
-                          'updated': u'2017-03-17 05:19:37.500000000',
-                          'patch_set': 2,
-                          'side': 'REVISION',
-                          'message': 'Please include a bug link',
-                      },
-                  ],
-                  'codereview.settings': [
-                      {
-                          'author': {
-                              'email': u'owner@example.com'
-                          },
-                          'updated': u'2017-03-16 20:00:41.000000000',
-                          'patch_set': 2,
-                          'side': 'PARENT',
-                          'line': 42,
-                          'message': 'I removed this because it is bad',
-                      },
-                  ]
-              }),
-            (('GetChangeRobotComments', 'chromium-review.googlesource.com',
-              'infra%2Finfra~1'), {}),
-        ] * 2 + [(('write_json', 'output.json', [{
+        mock.patch('git_cl.gerrit_util.GetChangeComments',
+                   return_value={
+                       '/COMMIT_MSG': [
+                           {
+                               'author': {
+                                   'email': u'reviewer@example.com'
+                               },
+                               'updated': u'2017-03-17 05:19:37.500000000',
+                               'patch_set': 2,
+                               'side': 'REVISION',
+                               'message': 'Please include a bug link',
+                           },
+                       ],
+                       'codereview.settings': [
+                           {
+                               'author': {
+                                   'email': u'owner@example.com'
+                               },
+                               'updated': u'2017-03-16 20:00:41.000000000',
+                               'patch_set': 2,
+                               'side': 'PARENT',
+                               'line': 42,
+                               'message': 'I removed this because it is bad',
+                           },
+                       ]
+                   }).start()
+        mock.patch('git_cl.gerrit_util.GetChangeRobotComments',
+                   return_value={}).start()
+        self.calls = [(('write_json_iter', 'output.json', [{
             u'date':
             u'2017-03-16 20:00:41.000000',
             u'message': (u'PTAL\n' + u'\n' + u'codereview.settings\n' +
@@ -3366,6 +4005,10 @@ class TestGitCl(unittest.TestCase):
         self.assertEqual(cl.GetCommentsSummary(), expected_comments_summary)
         self.assertEqual(
             0, git_cl.main(['comments', '-i', '1', '-j', 'output.json']))
+        gerrit_util.GetChangeComments.assert_called_with(
+            'chromium-review.googlesource.com', 'infra%2Finfra~1')
+        gerrit_util.GetChangeRobotComments.assert_called_with(
+            'chromium-review.googlesource.com', 'infra%2Finfra~1')
 
     @unittest.skipIf(gclient_utils.IsEnvCog(),
                     'not supported in non-git environment')
@@ -3441,28 +4084,26 @@ class TestGitCl(unittest.TestCase):
                 },
             ]
         }
-        self.calls = [
-            (('GetChangeComments', 'x-review.googlesource.com',
-              'infra%2Finfra~1'), {}),
-            (('GetChangeRobotComments', 'x-review.googlesource.com',
-              'infra%2Finfra~1'), {
-                  'codereview.settings': [
-                      {
-                          u'author': {
-                              u'email': u'tricium@serviceaccount.com'
-                          },
-                          u'updated': u'2017-03-17 05:30:37.000000000',
-                          u'robot_run_id': u'5565031076855808',
-                          u'robot_id': u'Linter/Category',
-                          u'tag': u'autogenerated:tricium',
-                          u'patch_set': 2,
-                          u'side': u'REVISION',
-                          u'message': u'Linter warning message text',
-                          u'line': 32,
-                      },
-                  ],
-              }),
-        ]
+        mock.patch('git_cl.gerrit_util.GetChangeComments',
+                   return_value={}).start()
+        mock.patch('git_cl.gerrit_util.GetChangeRobotComments',
+                   return_value={
+                       'codereview.settings': [
+                           {
+                               u'author': {
+                                   u'email': u'tricium@serviceaccount.com'
+                               },
+                               u'updated': u'2017-03-17 05:30:37.000000000',
+                               u'robot_run_id': u'5565031076855808',
+                               u'robot_id': u'Linter/Category',
+                               u'tag': u'autogenerated:tricium',
+                               u'patch_set': 2,
+                               u'side': u'REVISION',
+                               u'message': u'Linter warning message text',
+                               u'line': 32,
+                           },
+                       ],
+                   }).start()
         expected_comments_summary = [
             git_cl._CommentSummary(
                 date=datetime.datetime(2017, 3, 17, 5, 30, 37),
@@ -3478,6 +4119,10 @@ class TestGitCl(unittest.TestCase):
         ]
         cl = git_cl.Changelist(issue=1, branchref='refs/heads/foo')
         self.assertEqual(cl.GetCommentsSummary(), expected_comments_summary)
+        gerrit_util.GetChangeComments.assert_called_once_with(
+            'x-review.googlesource.com', 'infra%2Finfra~1')
+        gerrit_util.GetChangeRobotComments.assert_called_once_with(
+            'x-review.googlesource.com', 'infra%2Finfra~1')
 
     def test_get_remote_url_with_mirror(self):
         original_os_path_isdir = os.path.isdir
@@ -3560,6 +4205,17 @@ class TestGitCl(unittest.TestCase):
         cl = git_cl.Changelist(issue=123456)
         self.assertEqual(cl._GerritChangeIdentifier(), 'my%2Frepo~123456')
 
+    def test_gerrit_project_is_cached(self):
+        scm.GIT.SetConfig('', 'remote.origin.url',
+                          'https://chromium.googlesource.com/a/my/repo.git/')
+        cl = git_cl.Changelist(issue=123456)
+        self.assertEqual(cl.GetGerritProject(), 'my/repo')
+
+        scm.GIT.SetConfig('', 'remote.origin.url',
+                          'https://chromium.googlesource.com/other/repo')
+        self.assertEqual(cl.GetGerritProject(), 'my/repo')
+        self.assertEqual(cl._GetGitHost(), 'chromium.googlesource.com')
+
     def test_gerrit_change_identifier_without_project(self):
         mock.patch('logging.error',
                    lambda *a: self._mocked_call('logging.error', *a)).start()
@@ -3613,6 +4269,263 @@ class ChangelistTest(unittest.TestCase):
         self.temp_count = 0
         gerrit_util._Authenticator._resolved = None
 
+    @mock.patch('git_cl.Settings.GetCacheChangeDetails', return_value=True)
+    @mock.patch('gerrit_util.SubmitChange')
+    @mock.patch('gerrit_util.GetChangeDetailIfModified')
+    def testGetChangeDetail_DiskCache(self, mockGetChangeDetail, *_mocks):
+        home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home)
+        mock.patch.dict('os.environ', {
+            'HOME': home,
+            'USERPROFILE': home
+        }).start()
+        git_cl.time_time.return_value = 100
+        host = 'chromium-review.googlesource.com'
+
+        mockGetChangeDetail.return_value = ('etag', {'status': 'NEW'})
+        cl = git_cl.Changelist(codereview_host=host)
+        self.assertEqual({'status': 'NEW'}, cl._GetChangeDetail(['LABELS']))
+        mockGetChangeDetail.assert_called_with(host, 'project~123456',
+                                               ['LABELS'], None)
+
+        # A new Changelist revalidates the copy stored on disk.
+        mockGetChangeDetail.return_value = ('etag', None)
+        cl = git_cl.Changelist(codereview_host=host)
+        self.assertEqual({'status': 'NEW'}, cl._GetChangeDetail(['LABELS']))
+        mockGetChangeDetail.assert_called_with(host, 'project~123456',
+                                               ['LABELS'], 'etag')
+
+        # Writes to the change drop the copy stored on disk.
+        cl.SubmitIssue()
+        mockGetChangeDetail.return_value = ('etag2', {'status': 'MERGED'})
+        cl = git_cl.Changelist(codereview_host=host)
+        self.assertEqual({'status': 'MERGED'},
+                         cl._GetChangeDetail(['LABELS']))
+        mockGetChangeDetail.assert_called_with(host, 'project~123456',
+                                               ['LABELS'], None)
+
+    @mock.patch('gerrit_util.GetChangeDetail')
+    def testFetchDescription_ReusesStatusDetail(self, mockGetChangeDetail):
+        # git cl status prints the current CL's description after fetching
+        # its status; that must not cost another request.
+        mockGetChangeDetail.return_value = {
+            'status': 'MERGED',
+            'current_revision': 'abc',
+            'revisions': {
+                'abc': {
+                    'commit': {
+                        'message': 'Description\n'
+                    }
+                }
+            },
+        }
+        cl = git_cl.Changelist(
+            codereview_host='chromium-review.googlesource.com')
+        self.assertEqual('closed', cl.GetStatus())
+        self.assertEqual('  Description', cl.FetchDescription(pretty=True))
+        mockGetChangeDetail.assert_called_once()
+
+    @mock.patch('git_cl._prepare_superproject_push_option',
+                return_value='custom-keyed-value=rootRepo:host/project')
+    def testGetSuperprojectPushOption_Cached(self, mockPrepare):
+        cl = git_cl.Changelist()
+        for _ in range(2):
+            self.assertEqual('custom-keyed-value=rootRepo:host/project',
+                             cl._GetSuperprojectPushOption())
+        mockPrepare.assert_called_once_with()
+
+    @mock.patch('git_cl.confirm_or_exit')
+    @mock.patch('git_cl.ask_for_explicit_yes', return_value=True)
+    @mock.patch('git_cl.Changelist.GetCommonAncestorWithUpstream',
+                return_value='local-base')
+    @mock.patch('git_common.upstream', return_value='origin/main')
+    @mock.patch('git_common.current_branch', return_value='main')
+    @mock.patch('git_cl.Changelist._GetChangeCommit')
+    @mock.patch('gerrit_util.GetChangeDetail')
+    def testUpdateWithExternalChanges_UsesCurrentCommit(
+            self, mockGetChangeDetail, mockGetChangeCommit, *_mocks):
+        mock.patch('git_cl.Changelist.GetPatchset', return_value=1).start()
+        mock.patch('sys.stdout', io.StringIO()).start()
+        mockGetChangeDetail.return_value = {
+            'current_revision': 'commit2',
+            'revisions': {
+                'commit1': {
+                    '_number': 1,
+                    'kind': 'REWORK'
+                },
+                'commit2': {
+                    '_number': 2,
+                    'kind': 'REWORK',
+                    'commit': {
+                        'parents': [{
+                            'commit': 'external-base'
+                        }]
+                    },
+                },
+            },
+        }
+        cl = git_cl.Changelist()
+
+        self.assertIsNone(cl._UpdateWithExternalChanges())
+        mockGetChangeCommit.assert_not_called()
+        self.assertIn('Local merge base local-base is different from Gerrit '
+                      'external-base', sys.stdout.getvalue())
+        git_cl.confirm_or_exit.assert_called_once()
+
+    @mock.patch('git_cl.confirm_or_exit')
+    @mock.patch('git_cl.ask_for_explicit_yes', return_value=True)
+    @mock.patch('git_cl.Changelist.GetCommonAncestorWithUpstream',
+                return_value='external-base')
+    @mock.patch('git_cl.Changelist.GetRemoteBranch',
+                return_value=('origin', 'refs/remotes/origin/main'))
+    @mock.patch('git_common.current_branch', return_value='main')
+    @mock.patch('scm.GIT.IsValidRevision', return_value=False)
+    @mock.patch('git_cl.RunGitSilent')
+    @mock.patch('git_cl.Changelist._GetChangeCommit')
+    @mock.patch('gerrit_util.GetChangeDetail')
+    def testUpdateWithExternalChanges_FetchesBaseSeparately(
+            self, mockGetChangeDetail, mockGetChangeCommit, mockRunGitSilent,
+            *_mocks):
+        mock.patch('git_cl.Changelist.GetPatchset', return_value=1).start()
+        mock.patch('sys.stdout', io.StringIO()).start()
+        base = {'parents': [{'commit': 'external-base'}]}
+        mockGetChangeDetail.return_value = {
+            'current_revision': 'commit2',
+            'revisions': {
+                'commit1': {
+                    '_number': 1,
+                    'kind': 'REWORK'
+                },
+                'commit2': {
+                    '_number': 2,
+                    'kind': 'REWORK',
+                    'commit': base,
+                },
+            },
+        }
+        mockGetChangeCommit.return_value = base
+        # Stop at the parent check, once both fetches have run.
+        mockRunGitSilent.side_effect = ['', '', 'parent1\nparent2\n']
+        cl = git_cl.Changelist(issue=123456)
+
+        self.assertIsNone(cl._UpdateWithExternalChanges())
+        self.assertEqual([
+            mock.call(['fetch', 'origin', 'external-base']),
+            mock.call([
+                'fetch', 'origin', 'refs/changes/56/123456/1',
+                'refs/changes/56/123456/2'
+            ]),
+            mock.call(['rev-parse', 'commit1~1', 'commit2~1']),
+        ], mockRunGitSilent.mock_calls)
+
+    @mock.patch('git_cl.run_in_background')
+    @mock.patch('git_cl.Changelist._FinalizeGitPushTraces')
+    @mock.patch('tempfile.mkdtemp', return_value='traces')
+    @mock.patch('git_cl.Changelist._GetSuperprojectPushOption',
+                return_value=None)
+    @mock.patch('git_cl.Changelist.GetRemoteUrl', return_value='url')
+    @mock.patch('gclient_utils.CheckCallAndFilter')
+    def testRunGitPushWithTraces_BlockedKeyword(self, mockCheckCallAndFilter,
+                                                _mockGetRemoteUrl,
+                                                _mockGetSuperprojectPushOption,
+                                                _mockMkdtemp, mockFinalize,
+                                                mockRunInBackground):
+        mockCheckCallAndFilter.side_effect = subprocess2.CalledProcessError(
+            1, ['git', 'push'], None,
+            b'remote: ERROR: blocked keyword(s) found\n', None)
+        cl = git_cl.Changelist()
+        with self.assertRaises(git_cl.GitPushError) as cm:
+            cl._RunGitPushWithTraces('HEAD:refs/for/main', [], {})
+        self.assertIn('blocked keyword', str(cm.exception))
+        # The traces the error refers to are stored before it is raised.
+        mockFinalize.assert_called_once_with(mock.ANY, 'traces', mock.ANY)
+        mockRunInBackground.assert_not_called()
+
+    @mock.patch('git_cl.ResolveGitObjects')
+    def testComputeParent_LocalUpstream(self, mockResolveGitObjects):
+        scm.GIT.SetConfig('root', 'branch.upstream.gerritsquashhash',
+                          'squashed')
+        mockResolveGitObjects.return_value = ['tree', 'tree']
+        cl = git_cl.Changelist()
+        self.assertEqual(
+            'squashed',
+            cl._ComputeParent('.', 'refs/heads/upstream', None, False, None))
+        mockResolveGitObjects.assert_called_once_with(
+            ['refs/heads/upstream:', 'squashed:'])
+
+        mockResolveGitObjects.return_value = ['tree', 'other-tree']
+        mock.patch('sys.stderr', io.StringIO()).start()
+        with self.assertRaises(SystemExitMock):
+            cl._ComputeParent('.', 'refs/heads/upstream', None, False, None)
+        self.assertIn('Upload upstream branch', sys.stderr.getvalue())
+
+    @mock.patch('gerrit_util.ValidAccounts')
+    def testGetValidAccounts_Cached(self, mockValidAccounts):
+        mockValidAccounts.return_value = {'a@example.com': {}}
+        cl = git_cl.Changelist(
+            codereview_host='example-review.googlesource.com')
+        for _ in range(2):
+            self.assertEqual({'a@example.com'},
+                             cl._GetValidAccounts(['a@example.com', 'b']))
+        mockValidAccounts.assert_called_once_with(
+            'example-review.googlesource.com', ['a@example.com', 'b'])
+
+    @mock.patch('git_cl.Changelist.SetPatchset')
+    @mock.patch('git_cl.Changelist._GetChangeDetail')
+    def testGetMostRecentDryRunPatchset(self, mockGetChangeDetail,
+                                        mockSetPatchset):
+        kinds = ['REWORK', 'REWORK', 'TRIVIAL_REBASE', 'NO_CODE_CHANGE']
+        mockGetChangeDetail.return_value = {
+            'current_revision': 'rev4',
+            'revisions': {
+                'rev%d' % ps: {
+                    '_number': ps,
+                    'kind': kind
+                }
+                for ps, kind in enumerate(kinds, 1)
+            },
+            'messages': [],
+        }
+        cl = git_cl.Changelist()
+        self.assertEqual(4, cl.GetMostRecentDryRunPatchset())
+
+        messages = mockGetChangeDetail.return_value['messages']
+        messages.append({'_revision_number': 1, 'tag': 'cq:dry-run'})
+        self.assertEqual(4, cl.GetMostRecentDryRunPatchset())
+
+        messages.append({'_revision_number': 2, 'tag': 'cq:dry-run'})
+        self.assertEqual(2, cl.GetMostRecentDryRunPatchset())
+
+        messages.append({'_revision_number': 3, 'tag': 'cq:dry-run'})
+        self.assertEqual(3, cl.GetMostRecentDryRunPatchset())
+        mockSetPatchset.assert_called_with(3)
+
+    @mock.patch('git_cl.Changelist._GetChangeDetail')
+    def testIsPatchsetRangeSignificant(self, mockGetChangeDetail):
+        mockGetChangeDetail.return_value = {
+            'revisions': {
+                'a': {
+                    '_number': 1,
+                    'kind': 'REWORK'
+                },
+                'b': {
+                    '_number': 2,
+                    'kind': 'NO_CODE_CHANGE'
+                },
+                'c': {
+                    '_number': 3,
+                    'kind': 'TRIVIAL_REBASE'
+                },
+            }
+        }
+        cl = git_cl.Changelist()
+        self.assertFalse(cl._IsPatchsetRangeSignificant(2, 2))
+        self.assertTrue(cl._IsPatchsetRangeSignificant(2, 3))
+        self.assertTrue(cl._IsPatchsetRangeSignificant(1, 2))
+        del mockGetChangeDetail.return_value['revisions']['c']
+        with self.assertRaises(AssertionError):
+            cl._IsPatchsetRangeSignificant(2, 3)
+
     def testRunHook(self):
         expected_results = {
             'more_cc': ['cc@example.com', 'more@example.com'],
@@ -3923,6 +4836,33 @@ class ChangelistTest(unittest.TestCase):
         gclient_utils.FileWrite.assert_called_once_with('/tmp/fake-temp1',
                                                         'description')
 
+    def testGetCommonPresubmitArgs_GerritArgsComputedOnce(self):
+        cl = git_cl.Changelist()
+        cl._GetCommonPresubmitArgs(0, 'upstream')
+        args = cl._GetCommonPresubmitArgs(1, 'upstream')
+
+        self.assertEqual(args, [
+            '--root',
+            'root',
+            '--upstream',
+            'upstream',
+            '--verbose',
+            '--gerrit_url',
+            'https://chromium-review.googlesource.com',
+            '--gerrit_project',
+            'project',
+            '--gerrit_branch',
+            'refs/heads/main',
+            '--author',
+            'author',
+            '--issue',
+            '123456',
+            '--patchset',
+            '7',
+        ])
+        git_cl.Changelist.GetRemoteBranch.assert_called_once_with()
+        git_cl.Changelist.GetGerritProject.assert_called_once_with()
+
     @mock.patch('git_cl.RunGit', _mock_run_git)
     def testDefaultTitleEmptyMessage(self):
         cl = git_cl.Changelist()
@@ -4345,6 +5285,18 @@ class CMDPresubmitTestCase(CMDTestCaseBase):
             resultdb=None,
             realm=None)
 
+    @mock.patch('sys.stdout', io.StringIO())
+    def testFetchDescriptionFails(self):
+        git_cl.Changelist.FetchDescription.side_effect = (
+            gerrit_util.GerritError(404, 'Not found'))
+        self.assertEqual(0, git_cl.main(['presubmit']))
+        self.assertIn('Failed to fetch CL description', sys.stdout.getvalue())
+        git_cl._create_description_from_log.assert_called_once_with(
+            ['upstream'])
+        self.assertEqual(
+            'get description',
+            git_cl.Changelist.RunHook.call_args.kwargs['description'])
+
     def testCustomBranch(self):
         self.assertEqual(0, git_cl.main(['presubmit', 'custom_branch']))
         git_cl.Changelist.RunHook.assert_called_once_with(
@@ -5445,6 +6397,31 @@ class CMDLintTestCase(CMDTestCaseBase):
         self.assertIn('pdf.cc:3:  (cpplint) Do not indent within a namespace',
                       git_cl.sys.stderr.getvalue())
 
+    def testLintManyFilesInParallel(self, *_mock):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        files = []
+        for i in range(git_cl._LINT_PARALLEL_MIN_FILES):
+            path = os.path.join(temp_dir, 'f%d.h' % i)
+            with open(path, 'w') as f:
+                f.write(self.bad_indent)
+            files.append(path)
+        codecs.open().read.return_value = self.bad_indent
+        self.assertEqual(1, git_cl.main(['lint'] + files))
+        errors = [
+            line for line in git_cl.sys.stderr.getvalue().splitlines()
+            if 'Do not indent within a namespace' in line
+        ]
+        self.assertEqual(['%s:3:' % path for path in files],
+                         [line.split('  ')[0] for line in errors])
+
+    def testLintInvalidJobs(self, *_mock):
+        mock.patch('sys.stderr', io.StringIO()).start()
+        for jobs in ('0', '-1'):
+            with self.assertRaises(SystemExit):
+                git_cl.main(['lint', '-j', jobs, 'pdf.h'])
+            self.assertIn('--jobs must be >= 1', sys.stderr.getvalue())
+
     @unittest.skipIf(gclient_utils.IsEnvCog(),
                     'not supported in non-git environment')
     @mock.patch('git_cl.Changelist.GetAffectedFiles',